@@ -3,6 +3,7 @@ import os
 import sys
 import pickle
 import argparse
+import functools
 import datetime
 import numpy as np
 from datetime import datetime
@@ -18,19 +19,13 @@ sys.path.append(os.path.join(os.path.dirname(__file__), 'layer'))  # noqa
 sys.path.append(os.path.join(os.path.dirname(__file__), 'util'))  # noqa
 from model_gnn_mlp import GNN  # noqa
 import util_dataloader as util_dataloader  # noqa
+import util_graph  # noqa
 
 mpl.use('Agg')
 
 torch.autograd.set_detect_anomaly(True)
 
 
-def adj2lap(A):
-    A = A + torch.eye(A.shape[0])
-    D_sqrt_inv = torch.diag(1 / torch.sqrt(A.sum(dim=1)))
-    A = D_sqrt_inv @ A @ D_sqrt_inv
-    return A
-
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='PyTorch Example')
     parser.add_argument('--expid', type=int, default=0)
@@ -65,6 +60,29 @@ if __name__ == '__main__':
     parser.add_argument('--dp', type=float, default=0.2)
     parser.add_argument('--act', type=str, default='selu')
 
+    parser.add_argument('--noise', type=int, default=None,
+                        help='replicate of the poisson noise added to the outcome')
+    parser.add_argument('--outcome_times', action='store_true',
+                        help='load event times and build the curves on the device')
+    parser.add_argument('--time_step', type=int, default=1,
+                        help='seconds per time step of the outcome curves, '
+                        'set --dout to ceil(T / time_step)')
+    parser.add_argument('--preload', action='store_true',
+                        help='load all samples into memory once')
+    parser.add_argument('--device_loader', action='store_true',
+                        help='keep the whole splits on the device (small datasets)')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='batches copied to the device ahead of the step (0: off)')
+    parser.add_argument('--sparse', action='store_true',
+                        help='sparse (CSR) seat graphs in the graph convolutions')
+    parser.add_argument('--block_venues', action='store_true',
+                        help='one repnet pass over the block-diagonal graph of the six venues')
+    parser.add_argument('--occupied', action='store_true',
+                        help='graph convolutions only propagate from the occupied seats '
+                        '(block-diagonal graph of the venues)')
+    parser.add_argument('--sgc', type=int, default=0,
+                        help='hops of the occupancy propagated in the preprocessing '
+                        '(prop stage of preproc_all.py) for an SGC repnet (0: GCN repnet)')
     parser.add_argument('--disable-cuda', action='store_true',
                         help='Disable CUDA')
     args = parser.parse_args()
@@ -83,8 +101,6 @@ if __name__ == '__main__':
     torch.manual_seed(1)
     # -------------------------------- #
     dirpath = f'{os.getcwd()}/data/'
-    traintestpath = './data/dataset_%d/traintest_%s/' % (
-        args.expid, args.traintest)
 
 
     _savepath = '%s/dataset_%d/guide%d/out/' % (
@@ -132,44 +148,66 @@ if __name__ == '__main__':
     args.log_dir = writer.log_dir
     # -------------------------------- #
 
-    _train_id = np.loadtxt('%s/prop_train_id.csv' % (traintestpath))
-    test_id = np.loadtxt('%s/prop_test_id.csv' % (traintestpath))
+    _train_id, test_id = util_dataloader.load_traintest(
+        dirpath, args.expid, args.traintest)
     train_id, valid_id = train_test_split(
         _train_id, random_state=123, test_size=1-args.trainprop)
 
+    context = util_dataloader.ShinkokuContext(
+        a=args.a, Nguide=args.guide, expid=args.expid)
     train_dataset = util_dataloader.ShinkokuDataset(
-        id=train_id, Nguide=args.guide, a=args.a, mode='train', expid=args.expid)
-    A = train_dataset.graph.get()
-    W = train_dataset.getseatgraph.get_graph()
-
-    A = adj2lap(A)
-    for key in W.keys():
-        W[key] = adj2lap(W[key])
+        id=train_id, mode='train', context=context,
+        outcome_times=args.outcome_times, noise=args.noise,
+        preload=args.preload, prop_k=args.sgc, step=args.time_step)
+    # normalized adjacency (util_graph.adj2lap), cached on disk
+    A = context.A
+    W = dict(context.W)
+    if args.sparse:
+        W = util_graph.to_sparse(W)
 
     y_scaler = ''
     model = GNN(args.din, args.dtreat, args.dout,
                 A, W, y_scaler, writer, args).to(device=args.device)
 
     valid_dataset = util_dataloader.ShinkokuDataset(
-        id=valid_id, Nguide=args.guide, a=args.a, mode='valid', expid=args.expid)
+        id=valid_id, mode='valid', context=context,
+        outcome_times=args.outcome_times, noise=args.noise,
+        preload=args.preload, prop_k=args.sgc, step=args.time_step)
     test_dataset_cs = util_dataloader.ShinkokuDataset(
-        id=test_id, Nguide=args.guide, a=args.a, mode='train', expid=args.expid)
+        id=test_id, mode='train', context=context,
+        outcome_times=args.outcome_times, noise=args.noise,
+        preload=args.preload, prop_k=args.sgc, step=args.time_step)
 
     in_dataset = util_dataloader.ShinkokuDataset(
-        id=train_id, Nguide=args.guide, a=args.a, mode='test', expid=args.expid)
+        id=train_id, mode='test', context=context,
+        outcome_times=args.outcome_times, noise=args.noise,
+        preload=args.preload, prop_k=args.sgc, step=args.time_step)
     out_dataset = util_dataloader.ShinkokuDataset(
-        id=test_id, Nguide=args.guide, a=args.a, mode='test', expid=args.expid)
-
-    trainloader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=args.batch, shuffle=True, num_workers=2, drop_last=False)
-    validloader = torch.utils.data.DataLoader(
-        valid_dataset, batch_size=args.batch, shuffle=True, num_workers=2, drop_last=False)
-    testloader_cs = torch.utils.data.DataLoader(
-        test_dataset_cs, batch_size=args.batch, shuffle=True, num_workers=2, drop_last=False)
-    inloader = torch.utils.data.DataLoader(
-        in_dataset, batch_size=1, shuffle=False, num_workers=2, drop_last=False)
-    outloader = torch.utils.data.DataLoader(
-        out_dataset, batch_size=1, shuffle=False, num_workers=2, drop_last=False)
+        id=test_id, mode='test', context=context,
+        outcome_times=args.outcome_times, noise=args.noise,
+        preload=args.preload, prop_k=args.sgc, step=args.time_step)
+
+    if args.device_loader:
+        loader = functools.partial(util_dataloader.DeviceLoader, device=args.device)
+    elif args.prefetch > 0:
+        def loader(dataset, **kw):
+            # pinned batches copied to the device ahead of the step
+            return util_dataloader.Prefetcher(
+                util_dataloader.batch_loader(
+                    dataset, pin_memory=args.device.type == 'cuda', **kw),
+                args.device, depth=args.prefetch)
+    else:
+        loader = util_dataloader.batch_loader
+    trainloader = loader(
+        train_dataset, batch_size=args.batch, shuffle=True, drop_last=False)
+    validloader = loader(
+        valid_dataset, batch_size=args.batch, shuffle=True, drop_last=False)
+    testloader_cs = loader(
+        test_dataset_cs, batch_size=args.batch, shuffle=True, drop_last=False)
+    inloader = loader(
+        in_dataset, batch_size=1, shuffle=False, drop_last=False)
+    outloader = loader(
+        out_dataset, batch_size=1, shuffle=False, drop_last=False)
 
     if args.device == 'cuda':
         model = torch.nn.DataParallel(model)  # make parallel
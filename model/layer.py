@@ -161,12 +161,127 @@ class GraphConvolution(nn.Module):
     def forward(self, A, X):
         X = X.transpose(0, 1)
         X = torch.matmul(X, self.W) 
+        if A.layout != torch.strided:
+            # sparse A (e.g. to_sparse_csr), the nodes of all samples and
+            # features are the columns of one sparse-dense product A^T XW
+            P, N, D = X.shape
+            X = torch.sparse.mm(A.t(), X.reshape(P, N * D))
+            return X.reshape(P, N, D).transpose(0, 1)
         X = torch.matmul(X.transpose(0, 2), A) 
         X = X.transpose(0, 1)
         X = X.transpose(1, 2)
         return X
 
 
+def block_adjacency(As):
+    """
+    Sparse (CSR) block-diagonal adjacency of the graphs As (dense or sparse),
+    so that the graphs are convolved by one GraphConvolution call.
+    """
+    indices, values, offset = [], [], 0
+    for A in As:
+        A = A.to_sparse_coo().coalesce() if A.layout != torch.strided else A.to_sparse()
+        indices.append(A.indices() + offset)
+        values.append(A.values())
+        offset += A.shape[0]
+    return torch.sparse_coo_tensor(
+        torch.cat(indices, 1), torch.cat(values), (offset, offset)).to_sparse_csr()
+
+
+def segment_matrix(sizes):
+    # one-hot [P, V] of the graph (segment) of every node of block_adjacency
+    return torch.repeat_interleave(
+        torch.eye(len(sizes)), torch.tensor(sizes), dim=0)
+
+
+def segment_batch_norm(bn, X, S=None):
+    """
+    bn over every segment of the nodes separately, the same as
+    torch.cat([bn(x) for x in X.split(sizes, 2)], 2) (running statistics
+    updated segment by segment) with the statistics of all segments
+    computed at once.
+    X: [N, D, P], S: segment_matrix [P, V] (None: bn(X))
+    """
+    if S is None or not (bn.training or bn.running_mean is None):
+        return bn(X)
+    if isinstance(bn, nn.modules.lazy.LazyModuleMixin) and bn.has_uninitialized_params():
+        bn.initialize_parameters(X)
+    # [P, N, D], the memory layout of the sparse GraphConvolution
+    X = X.permute(2, 0, 1)
+    n = X.shape[1] * S.sum(0)[:, None]  # [V, 1]
+    # a segment may be empty (gather_graph_conv)
+    mean = S.t() @ X.sum(1) / n.clamp(min=1)  # [V, D]
+    X = X - (S @ mean)[:, None]
+    var = S.t() @ (X ** 2).sum(1) / n.clamp(min=1)
+    X = X * (S @ torch.rsqrt(var + bn.eps))[:, None]
+    if bn.affine:
+        X = X * bn.weight + bn.bias
+    if bn.training and bn.track_running_stats:
+        with torch.no_grad():
+            for mean_v, var_v, n_v in zip(mean, var * n / (n - 1), n):
+                if n_v <= 1:
+                    continue
+                bn.num_batches_tracked += 1
+                momentum = 1.0 / bn.num_batches_tracked.item() \
+                    if bn.momentum is None else bn.momentum
+                bn.running_mean.lerp_(mean_v, momentum)
+                bn.running_var.lerp_(var_v, momentum)
+    return X.permute(1, 2, 0)
+
+
+def segment_mean(X, S=None):
+    # readout [N, P, D] -> [N, D] (mean of the nodes), [N, V, D] by segment
+    if S is None:
+        return torch.mean(X, 1)
+    N, P, D = X.shape
+    X = S.t() @ X.transpose(0, 1).reshape(P, N * D) / S.sum(0)[:, None]
+    return X.reshape(-1, N, D).transpose(0, 1)
+
+
+def gather_graph_conv(A, src, H, P):
+    """
+    A^T H of GraphConvolution (H = XW) gathered from the (sample, node)
+    pairs src only, every other pair of H being zero: the messages are
+    the rows of A of the source nodes.
+    A: CSR [P, P], src: [S] flat ids sample * P + node, H: [S, D]
+    return: pairs reached (sorted flat ids) [M], A^T H on them [M, D]
+    """
+    crow, col, val = A.crow_indices(), A.col_indices(), A.values()
+    node = src % P
+    count = crow[node + 1] - crow[node]
+    edge = torch.repeat_interleave(torch.arange(len(src), device=src.device), count)
+    pos = crow[node][edge] + torch.arange(len(edge), device=src.device) \
+        - (torch.cumsum(count, 0) - count)[edge]
+    dst, inv = torch.unique(src[edge] - node[edge] + col[pos], return_inverse=True)
+    # one sparse [M, S] matrix of the messages instead of one row per edge
+    M = torch.sparse_coo_tensor(torch.stack([inv, edge]), val[pos], (len(dst), len(src)))
+    return dst, torch.sparse.mm(M.to_sparse_csr(), H)
+
+
+def occupied_graph_conv(gcs, bns, act, dp, A, X, S):
+    """
+    Graph convolutions of GCN_loading on the occupied seats only: the
+    first layer gathers from the nodes with X != 0, every next layer from
+    the pairs reached by the previous one (the k-hop subgraph). Nodes out
+    of reach keep a zero embedding instead of act(bn(0)), so the batch
+    norm statistics are over the reached pairs of each segment.
+    A: block_adjacency [P, P], X: [N, P] (one input feature),
+    S: segment_matrix [P, V]
+    return: readout per segment [N, V, D] as segment_mean
+    """
+    N, P = X.shape
+    X = X.reshape(-1)
+    src = torch.nonzero(X).squeeze(1)
+    H = X[src, None]
+    for gc, bn in zip(gcs, bns):
+        src, H = gather_graph_conv(A, src, H @ gc.W, P)
+        # [M, D] as a [1, D, M] batch of segment_batch_norm
+        H = act(dp(segment_batch_norm(bn, H.t()[None], S[src % P])[0].t()))
+    key = src // P * S.shape[1] + S[src % P].argmax(1)
+    out = H.new_zeros(N * S.shape[1], H.shape[1]).index_add_(0, key, H)
+    return out.reshape(N, S.shape[1], -1) / S.sum(0)[:, None]
+
+
 class GCN(nn.Module):
     def __init__(self, in_features, out_features=1, hidden_features=[32, 32], dp=0.1, act='selu'):
         super(GCN, self).__init__()
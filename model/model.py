@@ -20,6 +20,7 @@ from sklearn.metrics import mean_squared_error
 sys.path.append(os.path.join(os.path.dirname(__file__), 'util'))  # noqa
 from util.smoothmax import SmoothMax
 from bz2pickle import BZ2Pikcle
+import util_outcome
 
 from logging import getLogger
 logger = getLogger("Pytorch").getChild("model")
@@ -196,6 +197,20 @@ class Proto(nn.Module):
         '''
         return mmd
 
+    def data2outcome(self, data):
+        # outcome and mean, expanded on the device if the batch has event times
+        if 'times' not in data:
+            return (data['outcome'].to(device=self.args.device),
+                    data['mean'].to(device=self.args.device))
+        times = data['times'].to(device=self.args.device, non_blocking=True)
+        m = util_outcome.times2curve(
+            times, data['times_offset'], data['T'], data['step'])
+        m = m.reshape(list(data['times_shape']) + [-1])
+        if 'outcome' in data:
+            # noisy outcome built by the loader
+            return data['outcome'].to(device=self.args.device), m
+        return m, m
+
     def data2xrep(self, data):
         # [32, 22, 42]
         oh1f = data['oh1f'].to(device=self.args.device)
@@ -328,8 +343,7 @@ class Proto(nn.Module):
 
     def forward(self, data, data_cs):
         z = data['treatment'].to(device=self.args.device)
-        y = data['outcome'].to(device=self.args.device)
-        m = data['mean'].to(device=self.args.device)
+        y, m = self.data2outcome(data)
         if len(z.shape) == 3:
             z = z.squeeze(0)
             y = y.squeeze(0)
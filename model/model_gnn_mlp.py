@@ -8,7 +8,8 @@ from torch.optim.lr_scheduler import StepLR
 
 from matplotlib import pylab as plt
 from sklearn.metrics import mean_squared_error
-from layer import GraphConvolution
+from layer import GraphConvolution, block_adjacency, segment_matrix, \
+    segment_batch_norm, segment_mean, occupied_graph_conv
 from model import Proto
 
 from logging import getLogger
@@ -101,7 +102,7 @@ class GCN_loading(nn.Module):
         self.bn1 = nn.LazyBatchNorm1d()
         self.bn2 = nn.LazyBatchNorm1d()
 
-    def forward(self, A, X):
+    def forward(self, A, X, segment=None):
         """
         順方向の計算
 
@@ -114,20 +115,24 @@ class GCN_loading(nn.Module):
         X: torch.FloatTensor
             ノードの特徴量
             ノード数を n 特徴量の次元を d とすると (n, d) 行列
+
+        segment: torch.FloatTensor
+            A が会場のグラフの block_adjacency のときの segment_matrix
+            batch norm と readout を会場ごとに行う (N, V, d)
         """
         X = X.unsqueeze(2)
         # [N, P, D0] -> [N, P, D1]
         X = self.act(
             self.dp(
-                self.bn1(
-                    self.gc1(A, X).transpose(1, 2)
+                segment_batch_norm(
+                    self.bn1, self.gc1(A, X).transpose(1, 2), segment
                 )
             )
         ).transpose(1, 2)
         X = self.act(
             self.dp(
-                self.bn2(
-                    self.gc2(A, X).transpose(1, 2)
+                segment_batch_norm(
+                    self.bn2, self.gc2(A, X).transpose(1, 2), segment
                 )
             )
         ).transpose(1, 2)  # [N, P, D2]
@@ -140,17 +145,86 @@ class GCN_loading(nn.Module):
         # embed = x
         # X = self.dp(X)
 
-        X = torch.mean(X, 1)  # 全てのノードの埋め込みの平均を取ってグラフの特徴量とする (readout)
+        X = segment_mean(X, segment)  # 全てのノードの埋め込みの平均を取ってグラフの特徴量とする (readout)
         # x = torch.sum(X, 1)  # 全てのノードの埋め込みの平均を取ってグラフの特徴量とする (readout)
         return X
 
+    def forward_occupied(self, A, X, segment):
+        """
+        forward on the block_adjacency A of the venues that only propagates
+        from the occupied seats (see layer.occupied_graph_conv) [N, V, D2]
+        """
+        return occupied_graph_conv(
+            [self.gc1, self.gc2], [self.bn1, self.bn2], self.act, self.dp,
+            A, X, segment)
+
+
+class SGC_loading(nn.Module):
+    """
+    repnet on the occupancy propagated in the preprocessing (the 'xprop'
+    of preproc_xz.build_prop), no graph products in the training loop
+    """
+
+    def __init__(self, in_features, hidden_features, args):
+        """
+        パラメータ:
+        -----------
+        in_features: int
+            伝播の hop 数 K
+
+        hidden_features: int
+            隠れ層のユニット数
+        """
+        super(SGC_loading, self).__init__()
+        # GraphConvolution has no bias either
+        self.l1 = nn.Linear(in_features, hidden_features[0], bias=False)
+        self.l2 = nn.Linear(hidden_features[0], hidden_features[1], bias=False)
+        if args.act == 'selu':
+            self.act = F.selu
+        else:
+            self.act = F.relu
+        self.dp = nn.Dropout(args.dp)
+        self.bn1 = nn.LazyBatchNorm1d()
+        self.bn2 = nn.LazyBatchNorm1d()
+
+    def forward(self, X, segment):
+        """
+        X: torch.FloatTensor
+            (N, K, n) 会場ごとの (W^T)^k x, k = 1..K
+        segment: torch.FloatTensor
+            会場の segment_matrix, batch norm と readout を会場ごとに行う
+
+        return: (N, V, d)
+        """
+        # [N, K, P] -> [P, N, K], the layout of segment_batch_norm
+        X = X.permute(2, 0, 1)
+        for l, bn in [(self.l1, self.bn1), (self.l2, self.bn2)]:
+            X = self.act(
+                self.dp(
+                    segment_batch_norm(bn, l(X).permute(1, 2, 0), segment)
+                )
+            ).permute(2, 0, 1)
+        return segment_mean(X.transpose(0, 1), segment)
+
 
 class GNN(Proto):
     def __init__(self, din, dtreat, dout, A, W, y_scaler, writer, args):
         super().__init__(din, dtreat, dout, A, y_scaler, writer, args)
         self.W = W
+        self.venues = ['oh1f', 'oh2f', 'oh3f', 'oh4f', 'ph', 'tf']
+        if args.block_venues or args.occupied or args.sgc > 0:
+            self.register_buffer('segment', segment_matrix(
+                [W[k].shape[0] for k in self.venues]), persistent=False)
+        if args.block_venues or args.occupied:
+            # the six venues as one block-diagonal graph, one repnet pass
+            self.register_buffer('W_block', block_adjacency(
+                [W[k] for k in self.venues]), persistent=False)
         self.hist2cum = args.hist2cum
-        self.repnet = GCN_loading(din, args.rep_hidden, args)
+        if args.sgc > 0:
+            # the graph products of the first layer are precomputed
+            self.repnet = SGC_loading(args.sgc, args.rep_hidden, args)
+        else:
+            self.repnet = GCN_loading(din, args.rep_hidden, args)
         # self.outnet = MLP(3219, dout, args.out_hidden)
         # self.outnet = MLP(args.rep_hidden[-1]
         #                   *6+9, dout, args.out_hidden)  # flat
@@ -198,6 +272,22 @@ class GNN(Proto):
         return mmd
 
     def data2xrep(self, data):
+        if self.args.sgc > 0:
+            x_rep = self.repnet.forward(
+                data['xprop'].to(device=self.args.device), self.segment)
+            return x_rep.flip(1).reshape([len(x_rep), -1])
+        if self.args.occupied:
+            X = torch.cat([data[k] for k in self.venues], -1)
+            x_rep = self.repnet.forward_occupied(
+                self.W_block, X.to(device=self.args.device), self.segment)
+            return x_rep.flip(1).reshape([len(x_rep), -1])
+        if self.args.block_venues:
+            X = torch.cat([data[k] for k in self.venues], -1)
+            x_rep = self.repnet.forward(
+                self.W_block, X.to(device=self.args.device), self.segment)
+            # [tf, ph, oh4f, oh3f, oh2f, oh1f] as below
+            return x_rep.flip(1).reshape([len(x_rep), -1])
+
         # [32, 22, 42]
         oh1f = data['oh1f'].to(device=self.args.device)
         oh2f = data['oh2f'].to(device=self.args.device)
@@ -271,8 +361,7 @@ class GNN(Proto):
 
     def forward(self, data, data_cs):
         z = data['treatment'].to(device=self.args.device)
-        y = data['outcome'].to(device=self.args.device)
-        m = data['mean'].to(device=self.args.device)
+        y, m = self.data2outcome(data)
         # y = (data['outcome']/self.y_scaler.data_max_.max().astype(np.float32)
         #      ).to(device=self.args.device)
         # m = (data['mean']/self.y_scaler.data_max_.max()
@@ -11,7 +11,8 @@ from sklearn.metrics import mean_squared_error
 import itertools
 from tqdm import tqdm
 
-from layer import GraphConvolution
+from layer import GraphConvolution, block_adjacency, segment_matrix, \
+    segment_batch_norm, segment_mean, occupied_graph_conv
 from single_model import Proto
 
 sys.path.append(os.path.join(os.path.dirname(__file__), 'util'))  # noqa
@@ -62,32 +63,52 @@ class GCN_loading(nn.Module):
         self.bn1 = nn.LazyBatchNorm1d()
         self.bn2 = nn.LazyBatchNorm1d()
 
-    def forward(self, A, X):
+    def forward(self, A, X, segment=None):
+        """
+        segment: segment_matrix of the venues when A is their block_adjacency,
+                 the batch norm and the readout are then per venue [N, V, D2]
+        """
         X = X.unsqueeze(2)
         # [N, P, D0] -> [N, P, D1]
         X = self.act(
             self.dp(
-                self.bn1(
-                    self.gc1(A, X).transpose(1, 2)
+                segment_batch_norm(
+                    self.bn1, self.gc1(A, X).transpose(1, 2), segment
                 )
             )
         ).transpose(1, 2)
         X = self.act(
             self.dp(
-                self.bn2(
-                    self.gc2(A, X).transpose(1, 2)
+                segment_batch_norm(
+                    self.bn2, self.gc2(A, X).transpose(1, 2), segment
                 )
             )
         ).transpose(1, 2)  # [N, P, D2]
 
-        X = torch.mean(X, 1) 
+        X = segment_mean(X, segment)
         return X
 
+    def forward_occupied(self, A, X, segment):
+        """
+        forward on the block_adjacency A of the venues that only propagates
+        from the occupied seats (see layer.occupied_graph_conv) [N, V, D2]
+        """
+        return occupied_graph_conv(
+            [self.gc1, self.gc2], [self.bn1, self.bn2], self.act, self.dp,
+            A, X, segment)
+
 
 class GNN(Proto):
     def __init__(self, din, dtreat, dout, A, W, y_scaler, writer, args):
         super().__init__(din, dtreat, dout, A, y_scaler, writer, args)
         self.W = W
+        if args.block_venues or args.occupied:
+            # the six venues as one block-diagonal graph, one repnet pass
+            self.venues = ['oh1f', 'oh2f', 'oh3f', 'oh4f', 'ph', 'tf']
+            self.register_buffer('W_block', block_adjacency(
+                [W[k] for k in self.venues]), persistent=False)
+            self.register_buffer('segment', segment_matrix(
+                [W[k].shape[0] for k in self.venues]), persistent=False)
         self.repnet = GCN_loading(din, args.rep_hidden, args)
         self.outnet = MLP(args.rep_hidden[-1]*6
                           + 9 + 1, dout, args.out_hidden, args.dp, args.act)  # flat
@@ -135,6 +156,18 @@ class GNN(Proto):
         return mmd
 
     def data2xrep(self, data):
+        if self.args.occupied:
+            X = torch.cat([data[k] for k in self.venues], -1)
+            x_rep = self.repnet.forward_occupied(
+                self.W_block, X.to(device=self.args.device), self.segment)
+            return x_rep.flip(1).reshape([len(x_rep), -1])
+        if self.args.block_venues:
+            X = torch.cat([data[k] for k in self.venues], -1)
+            x_rep = self.repnet.forward(
+                self.W_block, X.to(device=self.args.device), self.segment)
+            # [tf, ph, oh4f, oh3f, oh2f, oh1f] as below
+            return x_rep.flip(1).reshape([len(x_rep), -1])
+
         # [32, 22, 42]
         oh1f = data['oh1f'].to(device=self.args.device)
         oh2f = data['oh2f'].to(device=self.args.device)
@@ -170,8 +203,7 @@ class GNN(Proto):
 
     def forward(self, data, data_cs):
         z = data['treatment'].to(device=self.args.device)
-        y = data['outcome'].to(device=self.args.device)
-        m = data['mean'].to(device=self.args.device)
+        y, m = self.data2outcome(data)
         if len(z.shape) == 3:
             z = z.squeeze(0)
             y = y.squeeze(0)
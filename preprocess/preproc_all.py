@@ -0,0 +1,375 @@
+# encoding: utf-8
+# !/usr/bin/env python3
+import io
+import hashlib
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from multiprocessing import Pool
+
+import preproc_x
+import preproc_xz
+import preproc_y
+import preproc_z
+import preproc_sample
+import util_seatimg
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'util'))  # noqa
+import util_store  # noqa
+import util_outcome  # noqa
+import util_graph  # noqa
+
+
+def line_offsets(fname, blocksize=1 << 26):
+    """
+    Byte offsets of the data rows of a csv file.
+
+    return: [n_rows + 1] array, row c is fname[offsets[c]:offsets[c+1]]
+    """
+    pos = []
+    size = 0
+    with open(fname, 'rb') as f:
+        for buf in iter(lambda: f.read(blocksize), b''):
+            pos.append(np.flatnonzero(
+                np.frombuffer(buf, dtype=np.uint8) == ord('\n')) + size)
+            size += len(buf)
+    pos = np.concatenate(pos) + 1
+    if pos[-1] != size:
+        # last line without newline
+        pos = np.r_[pos, size]
+    # pos[0] is the start of the first row after the header
+    return pos
+
+
+def read_rows(fname, start, end):
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        buf = f.read(end - start)
+    return pd.read_csv(io.BytesIO(buf), header=None).to_numpy(dtype=float)
+
+
+def hash_rows(fname, start, end):
+    h = hashlib.blake2b(digest_size=16)
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        h.update(f.read(end - start))
+    return h.hexdigest()
+
+
+def get_chunks(n_rows, chunksize):
+    return [(r0, min(r0 + chunksize, n_rows)) for r0 in range(0, n_rows, chunksize)]
+
+
+# -------------------- #
+# chunk workers. every worker writes its own row range of the store.
+_worker = {}
+
+
+def init_worker(dirpath):
+    _worker['dirpath'] = dirpath
+    _worker['writer'] = util_store.StoreWriter(dirpath + 'data/store/')
+
+
+def process_hash(args):
+    # content hash of the rows of a chunk in both csv files
+    (r0, r1), (ys, ye), (zs, ze) = args
+    dirpath = _worker['dirpath']
+    return r0, (hash_rows(dirpath + 'source/y.csv', ys, ye),
+                hash_rows(dirpath + 'source/x_z.csv', zs, ze))
+
+
+def process_x(args):
+    # seat images of preproc_x.py
+    (r0, r1), (ys, ye) = args
+    dirpath = _worker['dirpath']
+    if 'getseatimg' not in _worker:
+        with open(dirpath + 'source/y.csv') as f:
+            _seatname = f.readline().rstrip().split(',')
+        _worker['getseatimg'] = util_seatimg.GetSeatImg(
+            preproc_x.get_seatname(_seatname))
+    x = read_rows(dirpath + 'source/y.csv', ys, ye)
+    x = np.nan_to_num(x)
+    x[x != 0] = 1
+    for c, l_np in zip(range(r0, r1), x):
+        preproc_x.save_imgs(_worker['getseatimg'], l_np,
+                            c, dirpath + 'data/x/')
+    return r0, r1 - r0
+
+
+def process_xz(args):
+    (r0, r1), (ys, ye), (zs, ze) = args
+    dirpath = _worker['dirpath']
+    x = read_rows(dirpath + 'source/y.csv', ys, ye)[:, 1:]
+    z = read_rows(dirpath + 'source/x_z.csv', zs, ze)[:, 7:16]
+    x, z = preproc_xz.get_xz(x, z)
+    writer = _worker['writer']
+    preproc_xz.write_xz(writer.open('xbits'), writer.open('z'), r0, x, z,
+                        writer.open('row_group'), writer.open('row_inset'))
+    writer.open('xbits').flush()
+    writer.open('z').flush()
+    return r0, r1 - r0
+
+
+def process_y(args):
+    (r0, r1), (ys, ye) = args
+    dirpath = _worker['dirpath']
+    times = read_rows(dirpath + 'source/y.csv', ys, ye)[:, 1:]
+    preproc_y.write_events(_worker['writer'].path, r0,
+                           *util_outcome.get_events(times))
+    return r0, r1 - r0
+
+
+def process_expid(expid):
+    # preproc_z.py of one expid (legacy sampler)
+    s = time.time()
+    preproc_z.ShinkokuDataset_z(Nguide=4, dirname='guide4', expid=expid)
+    print('[expid %d] done in %.1f sec' % (expid, time.time() - s))
+    return expid, 1
+# -------------------- #
+
+
+def run_stage(pool, name, func, tasks, total, unit='row', done=None):
+    # done(key, result) is called in this process once a task has finished
+    s = time.time()
+    with tqdm(total=total, unit=unit, desc=name) as pbar:
+        for key, res in pool.imap_unordered(func, tasks):
+            pbar.update(res if done is None else done(key, res))
+    elapsed = time.time() - s
+    print('[%s] %d %ss in %.1f sec (%.1f %ss/sec)' %
+          (name, total, unit, elapsed, total / max(elapsed, 1e-9), unit))
+
+
+# store arrays written by each stage
+stage_arrays = {'x': [], 'xz': ['xbits', 'z'], 'y': ['event_offset'],
+                'eval': [], 'prop': [], 'expid': []}
+
+
+class ShinkokuPreprocess():
+    """
+    Chunked, resumable preprocessing.
+
+    The store manifest keeps, for every stage, the content hash of each chunk
+    that has been written. A rerun only processes chunks whose rows are new or
+    changed, and an interrupted run continues from the last finished chunk.
+    """
+
+    def __init__(self, stages, expids, T=1289+1, chunksize=1000, workers=None, force=False,
+                 sampler='vectorized', alist=[0.0, 1.0], prop_k=3):
+        dirpath = '../data/'
+        self.dirpath = dirpath
+        self.xname = dirpath + 'source/y.csv'
+        self.zname = dirpath + 'source/x_z.csv'
+        self.force = force
+        preproc_xz.mkdir(dirpath + 'data/')
+
+        # -------------------- #
+        # split both csv files into aligned row chunks
+        s = time.time()
+        yoff = line_offsets(self.xname)
+        zoff = line_offsets(self.zname)
+        n_rows = len(yoff) - 1
+        assert n_rows == len(zoff) - 1, 'y.csv and x_z.csv have different rows'
+        chunks = get_chunks(n_rows, chunksize)
+        yrange = [(yoff[r0], yoff[r1]) for r0, r1 in chunks]
+        zrange = [(zoff[r0], zoff[r1]) for r0, r1 in chunks]
+        print('[index] %d rows, %d chunks in %.1f sec' %
+              (n_rows, len(chunks), time.time() - s))
+
+        with open(self.xname) as fx, open(self.zname) as fz:
+            seatname = fx.readline().rstrip().split(',')
+            proptreat = fz.readline().rstrip().split(',')
+
+        self.writer = util_store.StoreWriter(dirpath + 'data/store/')
+        if 'xz' in stages or 'expid' in stages:
+            # groups of the same proportion, rebuilt when x_z.csv has changed
+            s = time.time()
+            zfile_hash = hash_rows(self.zname, zoff[0], zoff[-1])
+            if self.force or self.writer.manifest['attrs'].get('groups_hash') != zfile_hash:
+                data = pd.read_csv(self.zname)
+                groups = preproc_z.load_groups(
+                    dirpath, data.iloc[:, :7], data.iloc[:, 7:16], self.writer, rebuild=True)
+                self.writer.set_attr('groups_hash', zfile_hash)
+                self.writer.save()
+                del data
+            else:
+                groups = preproc_z.read_groups(self.writer)
+            print('[groups] %d groups in %.1f sec' %
+                  (len(groups['pop_unique']), time.time() - s))
+
+        # allocate (or grow) the store before the workers fill it
+        if 'xz' in stages:
+            preproc_xz.create_store(self.writer, n_rows, len(groups['pop_unique']),
+                                    seatname, proptreat)
+        if 'y' in stages:
+            preproc_y.create_store(self.writer, T)
+        self.writer.close()
+        # -------------------- #
+
+        with Pool(workers, initializer=init_worker, initargs=(dirpath,)) as pool:
+            hashes = {}
+
+            def add_hash(r0, h):
+                hashes[r0] = h
+                return min(r0 + chunksize, n_rows) - r0
+            run_stage(pool, 'hash', process_hash,
+                      list(zip(chunks, yrange, zrange)), n_rows, done=add_hash)
+            yhash = [hashes[r0][0] for r0, _ in chunks]
+            zhash = [hashes[r0][1] for r0, _ in chunks]
+
+            if 'x' in stages:
+                preproc_xz.mkdir(dirpath + 'data/x/')
+                todo = self.get_todo('x', {'chunksize': chunksize},
+                                     chunks, yhash)
+                self.run_chunks(pool, 'x', process_x,
+                                [(c, yrange[i]) for i, c in todo],
+                                [yhash[i] for i, c in todo])
+            if 'xz' in stages:
+                xzhash = [hy + hz for hy, hz in zip(yhash, zhash)]
+                # group ids change when a new proportion is added
+                pop_hash = hashlib.blake2b(
+                    groups['pop_unique'].tobytes(), digest_size=16).hexdigest()
+                todo = self.get_todo('xz', {'chunksize': chunksize, 'groups': pop_hash},
+                                     chunks, xzhash)
+                self.run_chunks(pool, 'xz', process_xz,
+                                [(c, yrange[i], zrange[i]) for i, c in todo],
+                                [xzhash[i] for i, c in todo])
+            if 'y' in stages:
+                if 'event_offset' not in self.writer.manifest['arrays']:
+                    # store written before the event times were kept
+                    self.writer.created.add('event_offset')
+                todo = self.get_todo('y', {'chunksize': chunksize},
+                                     chunks, yhash)
+                self.run_chunks(pool, 'y', process_y,
+                                [(c, yrange[i]) for i, c in todo],
+                                [yhash[i] for i, c in todo])
+                preproc_y.merge_events(self.writer, chunks)
+                self.writer.close()
+
+        if 'eval' in stages:
+            # curves of every (group, treatment) for the evaluation
+            s = time.time()
+            if preproc_y.build_eval(self.writer, force=self.force):
+                print('[eval] %d groups in %.1f sec' %
+                      (self.writer.manifest['arrays']['eval_mean']['shape'][0],
+                       time.time() - s))
+            else:
+                print('[eval] up to date')
+            self.writer.close()
+
+        if 'prop' in stages:
+            # occupancy propagated over the seat graphs (NN_gcn_mlp.py --sgc)
+            s = time.time()
+            _seatname = preproc_z.get_seatname(list(seatname))
+            graphs = util_graph.load_graphs(dirpath, _seatname)
+            key = util_store.prop_key(self.writer.open('xbits'),
+                                      util_graph.graph_key(dirpath, _seatname, False))
+            if preproc_xz.build_prop(self.writer, graphs, prop_k, key, force=self.force):
+                print('[prop] %d groups, %d hops in %.1f sec' %
+                      (self.writer.manifest['arrays']['xprop']['shape'][0], prop_k,
+                       time.time() - s))
+            else:
+                print('[prop] up to date')
+            self.writer.close()
+
+        if 'expid' in stages:
+            # every expid only depends on x_z.csv
+            h = zfile_hash
+            progress = self.get_progress(
+                'expid', {'hash': h, 'sampler': sampler, 'alist': list(alist)})
+            todo = [expid for expid in expids
+                    if progress['done'].get(str(expid)) != h]
+            print('[expid] %d of %d expids to process' % (len(todo), len(expids)))
+            if len(todo) == 0:
+                return
+
+            preproc_z.get_seatname(list(seatname)).to_csv(
+                dirpath + 'data/seatname.csv')
+            if sampler == 'vectorized':
+                # factual treatments of every expid and a at once
+                s = time.time()
+                preproc_z.generate_factual(
+                    dirpath, groups, util_store.SimulationStore(
+                        dirpath + 'data/store/'),
+                    todo, alist, Nguide=4, dirname='guide4')
+                print('[z] %d expids in %.1f sec' % (len(todo), time.time() - s))
+            else:
+                with Pool(min(len(todo), workers or os.cpu_count())) as pool:
+                    run_stage(pool, 'z', process_expid,
+                              todo, len(todo), unit='expid')
+
+            # every split of every expid at once
+            s = time.time()
+            splits = preproc_sample.get_splits(groups['pop_unique'], todo)
+            preproc_sample.save_splits(self.writer, dirpath, splits, todo)
+            print('[sample] %d splits of %d expids in %.1f sec' %
+                  (len(splits), len(todo), time.time() - s))
+
+            for expid in todo:
+                progress['done'][str(expid)] = h
+            self.writer.save()
+
+    def get_progress(self, stage, params):
+        # completion markers of a stage, reset when its parameters change
+        progress = self.writer.manifest.setdefault('progress', {})
+        if self.force or len(self.writer.created & set(stage_arrays[stage])) > 0 \
+                or progress.get(stage, {}).get('params') != params:
+            progress[stage] = {'params': params, 'done': {}}
+        return progress[stage]
+
+    def get_todo(self, stage, params, chunks, keys):
+        progress = self.get_progress(stage, params)
+        # drop markers of rows that no longer exist
+        n_rows = chunks[-1][1] if len(chunks) > 0 else 0
+        progress['done'] = {r0: key for r0, key in progress['done'].items()
+                            if int(r0) < n_rows}
+        todo = [(i, c) for i, c in enumerate(chunks)
+                if progress['done'].get(str(c[0])) != keys[i]]
+        print('[%s] %d of %d chunks to process' % (stage, len(todo), len(chunks)))
+        return todo
+
+    def run_chunks(self, pool, name, func, tasks, keys):
+        if len(tasks) == 0:
+            return
+        done = self.writer.manifest['progress'][name]['done']
+        key = {task[0][0]: k for task, k in zip(tasks, keys)}
+
+        def mark(r0, n):
+            # the worker has flushed its rows, so the marker can be written
+            done[str(r0)] = key[r0]
+            self.writer.save()
+            return n
+        run_stage(pool, name, func, tasks,
+                  sum(r1 - r0 for (r0, r1), *_ in tasks), done=mark)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='run the whole preprocessing in parallel')
+    parser.add_argument('--stages', type=str, default='xz,y,eval,expid',
+                        help='x (per-row seat image files in data/x/, only for image export) '
+                        'and prop are opt-in, training reads the store')
+    parser.add_argument('--expids', type=str, default='0,1,2,3,4,5,6,7,8,9')
+    parser.add_argument('--T', type=int, default=1289+1)
+    parser.add_argument('--chunksize', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--sampler', type=str, default='vectorized',
+                        choices=['vectorized', 'legacy'],
+                        help='legacy reproduces the per-expid np.random draws of preproc_z.py (a=1.0 only)')
+    parser.add_argument('--alist', type=str, default='0.0,1.0')
+    parser.add_argument('--prop_k', type=int, default=3,
+                        help='hops of the propagated occupancy of the (optional) prop stage')
+    parser.add_argument('--force', action='store_true',
+                        help='ignore the completion markers and rebuild everything')
+    args = parser.parse_args()
+
+    stages = args.stages.split(',')
+    expids = [int(x) for x in args.expids.split(',')]
+    ShinkokuPreprocess(stages, expids, T=args.T, chunksize=args.chunksize,
+                       workers=args.workers, force=args.force,
+                       sampler=args.sampler, alist=[float(x) for x in args.alist.split(',')],
+                       prop_k=args.prop_k)
+    print(0)
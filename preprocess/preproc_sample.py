@@ -4,12 +4,14 @@
 # import util_seatimg
 import matplotlib as mpl
 import os
-import pickle
+import sys
 import pandas as pd
 import numpy as np
-from os import path
 import argparse
-np.random.seed = 1234
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'util'))  # noqa
+import util_store  # noqa
+np.random.seed(1234)
 
 
 def get_seatname(_seatname):
@@ -56,58 +58,92 @@ def load_data(savepath, savename, train_id, test_id):
     np.savetxt('%s/prop_test_id.csv' % (savedir), test_id)
 
 
+# training percentage of the random splits rand_XX
+rand_percents = [5, 10, 30, 50, 70, 90]
+# seat capacity of the columns of the proportion
+_seat = np.array([358, 851, 187, 300, 292, 354, 868])
+
+
+def get_theater_prop(pop_unique):
+    # occupancy of TP, PH and OH for every proportion [U, 3]
+    _agent = (0.1*pop_unique)*_seat
+    _theater = np.array([358, 851 + 187, 300+292+354+868])
+    return np.c_[_agent[:, 0], _agent[:, 1:3].sum(1), _agent[:, 3:].sum(1)] / _theater
+
+
+def get_splits(pop_unique, expids):
+    """
+    Train/test splits of the proportions for every expid.
+
+    rand_XX  : XX% of the proportions at random (rand_50 is the original split)
+    strat_50 : half of the proportions of each stratum (most occupied theater)
+    extra_50 : the less occupied half for training, the rest for extrapolation
+    Only proportions with a theater occupied more than 50% are used.
+    return: {name: int8 [len(expids), U]}, 1 train, 0 test, -1 not used
+    """
+    U = len(pop_unique)
+    theater_prop = get_theater_prop(pop_unique)
+    used = (theater_prop > 0.5).sum(1) > 0
+
+    # one uniform draw per expid, the same as np.random.seed(expid+134)
+    u = np.stack([np.random.RandomState(expid+134).rand(U) for expid in expids])
+    flags = {'rand_%02d' % p: u < p/100 for p in rand_percents}
+
+    # rank of u inside each stratum
+    stratum = np.where(used, theater_prop.argmax(1), 3)
+    count = np.bincount(stratum, minlength=4)
+    start = np.r_[0, np.cumsum(count)][stratum]
+    order = np.lexsort((u, np.broadcast_to(stratum, u.shape)), axis=-1)
+    rank = np.empty_like(order)
+    np.put_along_axis(rank, order, np.broadcast_to(np.arange(U), u.shape), axis=-1)
+    flags['strat_50'] = (rank - start) < 0.5*count[stratum]
+
+    # occupancy of the whole building
+    level = (0.1*pop_unique*_seat).sum(1) / _seat.sum()
+    median = np.median(level[used]) if used.any() else 0
+    flags['extra_50'] = np.broadcast_to(level <= median, u.shape)
+
+    splits = {}
+    for name, flag in flags.items():
+        split = flag.astype(np.int8)
+        split[:, ~used] = -1
+        splits[name] = split
+    return splits
+
+
+def save_splits(writer, savepath, splits, expids):
+    """
+    Splits as 'split_<name>' [expid, U] in the store, and as the
+    traintest_<name>/prop_{train,test}_id.csv of every expid.
+    """
+    for name, split in splits.items():
+        n_exp = max(max(expids) + 1, writer.manifest['arrays'].get(
+            'split_' + name, {'shape': [0]})['shape'][0])
+        arr = writer.require('split_' + name, np.int8, [n_exp, split.shape[1]])
+        arr[expids] = split
+        for expid, _split in zip(expids, split):
+            _savepath = '%s/dataset_%d/' % (savepath, expid)
+            if not os.path.exists(_savepath):
+                os.mkdir(_savepath)
+            load_data(_savepath, 'traintest_' + name,
+                      np.where(_split == 1)[0], np.where(_split == 0)[0])
+    writer.save()
+
+
 class ShinkokuDataset_sample():
-    def __init__(self, csv_file='source/x_z.csv', withtime=False, expid=0):
+    def __init__(self, csv_file='source/x_z.csv', withtime=False, expid=0, expids=None):
         dirpath = '../data/'
-        savepath = '../data/dataset_%d/' % expid
-
         self.dirpath = dirpath
-        self.savepath = savepath
         self.withtime = withtime
-        if not os.path.exists(self.savepath):
-            os.mkdir(self.savepath)
-
-        self.data = pd.read_csv(dirpath + csv_file)
-        self.pop = self.data.iloc[:, :7]  # proportion
-        self.treatment = self.data.iloc[:, 7:16]  # intervention
-
-        f = open(dirpath + 'source/y.csv')
-        _seatname = f.readline().rstrip().split(',')
-        self.seatname = get_seatname(_seatname)
-
-        self.pop_unique = np.loadtxt(
-            dirpath + 'data/pop_unique.csv', delimiter=',')
-
-        if not path.exists(dirpath + 'data/pop_same.pkl'):
-            same_pop = []
-            for _pop_unique in self.pop_unique:
-                _same_pop = np.where((self.pop == _pop_unique).all(axis=1))[0]
-                same_pop.append(_same_pop)
-            with open(dirpath + 'data/pop_same.pkl', 'wb') as f:
-                pickle.dump(same_pop, f)
-        else:
-            with open(dirpath + 'data/pop_same.pkl', 'rb') as f:
-                same_pop = pickle.load(f)
-
-        # ------------------------------ #
-        df = pd.DataFrame(self.pop_unique, columns=self.data.columns[:7])
-        _seat = np.array([358, 851, 187, 300, 292, 354, 868])
-        _agent = ((0.1*df)*_seat)
-        _theater = np.array([358, 851 + 187, 300+292+354+868])
-        _tp = _agent['S_TP']
-        _ph = _agent['S_PH_2F'] + _agent['S_PH_3F']
-        _oh = _agent['S_OH_2F'] + _agent['S_OH_3F'] + \
-            _agent['S_OH_4F'] + _agent['S_OH_5F']
-        _theater_prop = np.c_[_tp, _ph, _oh] / _theater
-        theater_prop = (_theater_prop > 0.5).sum(1) > 0
-        # ------------------------------ #
-
-
-        np.random.seed = expid+134
-        flag = np.random.rand(flag.shape[0]) < 0.5  # training proportion
-        train_id = np.where((flag == True) & theater_prop)[0]
-        test_id = np.where((flag == False) & theater_prop)[0]
-        load_data(self.savepath, 'traintest_rand_50', train_id, test_id)
+        expids = [expid] if expids is None else expids
+
+        writer = util_store.StoreWriter(dirpath + 'data/store/')
+        self.pop_unique = np.array(writer.open('pop_unique'))
+
+        # every split family of all expids at once
+        splits = get_splits(self.pop_unique, expids)
+        save_splits(writer, dirpath, splits, expids)
+        writer.close()
 
         print(0)
 
@@ -115,7 +151,10 @@ class ShinkokuDataset_sample():
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='split train and test')
     parser.add_argument('--expid', type=int, default=0)
+    parser.add_argument('--expids', type=str, default=None,
+                        help='e.g. 0,1,2: all expids in one pass')
     args = parser.parse_args()
 
-    dataset = ShinkokuDataset_sample(expid=args.expid)
+    expids = None if args.expids is None else [int(x) for x in args.expids.split(',')]
+    dataset = ShinkokuDataset_sample(expid=args.expid, expids=expids)
     print(0)
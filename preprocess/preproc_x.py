@@ -38,6 +38,22 @@ def mkdir(path):
         os.mkdir(path)
 
 
+def save_imgs(getseatimg, l_np, c, savedir):
+    imgnames = ['oh1f', 'oh2f', 'oh3f', 'oh4f', 'ph1f', 'ph2f', 'tf']
+    l_sp = scipy.sparse.csc_matrix(l_np)
+    scipy.sparse.save_npz(savedir + 'seat_use_' + str(c), l_sp)
+
+    # save vectors
+    _imgs = getseatimg.get(l_np)
+    imgs = {}
+    for (i, img) in enumerate(_imgs):
+        img = scipy.sparse.csc_matrix(img)
+        imgs[imgnames[i]] = img
+    fname = savedir + 'imgs_' + str(c) + '.pkl'
+    with open(fname, 'wb') as f:
+        pickle.dump(imgs, f)
+
+
 class ShinkokuDataset_x(Dataset):
     """Face Landmarks dataset."""
 
@@ -54,7 +70,6 @@ class ShinkokuDataset_x(Dataset):
             self.seatname = get_seatname(_seatname)
             self.getseatimg = util_seatimg.GetSeatImg(
                 self.seatname, self.withtime)
-            imgnames = ['oh1f', 'oh2f', 'oh3f', 'oh4f', 'ph1f', 'ph2f', 'tf']
 
             for (c, l) in enumerate(tqdm(f)):
                 l = l.rstrip().split(',')
@@ -64,19 +79,7 @@ class ShinkokuDataset_x(Dataset):
                 l_np[l_np == ''] = 0
                 l_np = l_np.astype(float)
                 l_np[l_np != 0] = 1
-                l_sp = scipy.sparse.csc_matrix(l_np)
-                scipy.sparse.save_npz(
-                    self.savedir + 'seat_use_' + str(c), l_sp)
-
-                # save vectors
-                _imgs = self.getseatimg.get(l_np)
-                imgs = {}
-                for (i, img) in enumerate(_imgs):
-                    img = scipy.sparse.csc_matrix(img)
-                    imgs[imgnames[i]] = img
-                fname = self.savedir + 'imgs_' + str(c) + '.pkl'
-                with open(fname, 'wb') as f:
-                    pickle.dump(imgs, f)
+                save_imgs(self.getseatimg, l_np, c, self.savedir)
 
 
 
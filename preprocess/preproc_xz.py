@@ -5,15 +5,18 @@ import os
 import argparse
 import numpy as np
 import pandas as pd
+import torch
 from torch.utils.data import Dataset
 from tqdm import tqdm
-import scipy.sparse
-from copy import copy
-import pickle
+import sys
 
 import matplotlib as mpl
 mpl.use('Agg')
 
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'util'))  # noqa
+import util_store  # noqa
+import preproc_z  # noqa
+
 
 def get_seatname(_seatname):
     seatname = []
@@ -34,46 +37,118 @@ def pd_read_row(path, idx):
     return pd.read_csv(path, skiprows=lambda x: x not in [idx])
 
 
+def count_rows(fname):
+    # number of data rows (without header)
+    with open(fname, 'rb') as f:
+        n = sum(buf.count(b'\n') for buf in iter(lambda: f.read(1 << 24), b''))
+    return n - 1
+
+
+def create_store(writer, n_rows, n_groups, seatname, proptreat):
+    # occupancy (np.packbits of 0/1) of every group and treatment (0/1) of
+    # every simulation row. the occupancy is the same for all rows of a group
+    n_seats = len(seatname) - 1
+    # dense occupancy of older stores
+    writer.remove('x')
+    x_store = writer.require('xbits', np.uint8, [n_groups, (n_seats + 7) // 8])
+    z_store = writer.require('z', np.uint8, [n_rows, 9])
+    writer.set_attr('n_rows', n_rows)
+    writer.set_attr('n_seats', n_seats)
+    writer.set_attr('seatname', seatname[1:])
+    writer.set_attr('proptreat', proptreat)
+    return x_store, z_store
+
+
+def get_xz(x, z):
+    """
+    x: [N, seat] evacuation times of y.csv (nan for an empty seat)
+    z: [N, 9] guide columns of x_z.csv
+    return: bit-packed occupancy [N, ceil(seat/8)] and treatment as uint8
+    """
+    x = np.nan_to_num(x) != 0
+    z = np.nan_to_num(z)
+    return np.packbits(x, axis=1), z.astype(np.uint8)
+
+
+def write_xz(x_store, z_store, r0, x, z, row_group, row_inset):
+    # rows r0:r0+len(x). the occupancy is written by the first row of a group
+    z_store[r0:r0+len(z)] = z
+    first = row_inset[r0:r0+len(x)] == 0
+    x_store[row_group[r0:r0+len(x)][first]] = x[first]
+
+
+def build_prop(writer, graphs, K, key, chunksize=1024, force=False):
+    """
+    Occupancy of every group propagated over the seat graphs, 'xprop'
+    [U, K, seat of the six venues]: xprop[u, k - 1] is (W^T)^k x of each
+    venue (W normalized, see util_graph.load_graphs), in the order of the
+    covariate ids. These are the graph products of a first GraphConvolution
+    on the occupancy, done once instead of in every epoch (SGC features).
+    Skipped if the occupancy, the graphs and K have not changed.
+    """
+    attrs = writer.manifest['attrs']
+    info = writer.manifest['arrays'].get('xprop')
+    if not force and info is not None and info['shape'][1] == K \
+            and attrs.get('prop_key') == key:
+        return False
+    xbits = writer.open('xbits')
+    covariate_id = [c.numpy() for c in graphs['covariate_id']]
+    offset = np.r_[0, np.cumsum([len(c) for c in covariate_id])]
+    # the venues of W are in the order of the covariate ids
+    W = [w.t().to_sparse_csr() for w in graphs['W'].values()]
+    xprop = writer.create('xprop', np.float32, [len(xbits), K, offset[-1]])
+    for u0 in tqdm(range(0, len(xbits), chunksize)):
+        x = np.unpackbits(xbits[u0:u0 + chunksize], axis=1,
+                          count=attrs['n_seats']).astype(np.float32)
+        for c, w, o0, o1 in zip(covariate_id, W, offset[:-1], offset[1:]):
+            p = torch.from_numpy(np.ascontiguousarray(x[:, c].T))
+            for k in range(K):
+                p = torch.sparse.mm(w, p)
+                xprop[u0:u0 + chunksize, k, o0:o1] = p.t().numpy()
+    writer.set_attr('prop_key', key)
+    writer.save()
+    return True
+
+
 class ShinkokuDataset_x(Dataset):
-    def __init__(self, csv_file='each_seat_1_0.csv', withtime=False):
+    def __init__(self, csv_file='each_seat_1_0.csv', withtime=False, chunksize=1000):
         dirpath = '../data/'
         self.dirpath = dirpath
         self.withtime = withtime
-        self.savedir = dirpath + 'data/xz/'
-        mkdir(self.savedir)
+        self.savedir = dirpath + 'data/store/'
 
         self.xname = dirpath + 'source/y.csv'
         self.zname = dirpath + 'source/x_z.csv'
-
-        fx = open(self.xname)
-        fz = open(self.zname)
-
-        self.seatname = fx.readline().rstrip().split(',')
-        self.proptreat = fz.readline().rstrip().split(',')
-
-        for (c, lx) in enumerate(tqdm(fx)):
-            fname = self.savedir + 'xz_' + str(c) + '.pkl'
-            x = lx.rstrip().split(',')
-            x = x[1:]
-            _z = fz.readline().rstrip().split(',')
-            z = _z[7:16]
-
-            # ndarray
-            xnp = np.array(x)
-            znp = np.array(z)
-            xnp[xnp == ''] = 0
-            znp[znp == ''] = 0
-            xnp = xnp.astype(float)
-            znp = znp.astype(float)
-            xznp = np.r_[xnp, znp]
-            xzsp = scipy.sparse.csc_matrix(xznp)
-
-            with open(fname, 'wb') as f:
-                pickle.dump(xzsp, f)
+        n_rows = count_rows(self.xname)
+
+        with open(self.xname) as fx, open(self.zname) as fz:
+            self.seatname = fx.readline().rstrip().split(',')
+            self.proptreat = fz.readline().rstrip().split(',')
+
+        writer = util_store.StoreWriter(self.savedir)
+        data = pd.read_csv(self.zname)
+        groups = preproc_z.load_groups(
+            dirpath, data.iloc[:, :7], data.iloc[:, 7:16], writer, rebuild=True)
+        x_store, z_store = create_store(
+            writer, n_rows, len(groups['pop_unique']), self.seatname, self.proptreat)
+
+        fx = pd.read_csv(self.xname, chunksize=chunksize)
+        fz = pd.read_csv(self.zname, chunksize=chunksize)
+        c = 0
+        for (x, z) in zip(tqdm(fx, total=-(-n_rows // chunksize)), fz):
+            x, z = get_xz(x.iloc[:, 1:].to_numpy(dtype=float),
+                          z.iloc[:, 7:16].to_numpy(dtype=float))
+            write_xz(x_store, z_store, c, x, z,
+                     groups['row_group'], groups['row_inset'])
+            c += len(x)
+        writer.close()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='constrct vector of covariate and treatment')
-    dataset = ShinkokuDataset_x()
+    parser.add_argument('--chunksize', type=int, default=1000)
+    args = parser.parse_args()
+
+    dataset = ShinkokuDataset_x(chunksize=args.chunksize)
     print(0)
@@ -1,12 +1,17 @@
 # encoding: utf-8
 # !/usr/bin/env python3
 import os
+import sys
 from tqdm import tqdm
 import argparse
 import numpy as np
 import pandas as pd
 from torch.utils.data import Dataset
 
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'util'))  # noqa
+import util_store  # noqa
+import util_outcome  # noqa
+
 def mkdir(path):
     if not os.path.exists(path):
         os.mkdir(path)
@@ -28,44 +33,137 @@ def pd_read_row(path, idx):
     return pd.read_csv(path, skiprows=lambda x: x not in [idx])
 
 
+def create_store(writer, T):
+    # the curves (and their poisson noise) are built from the event times when
+    # they are read, T is their default length
+    writer.remove('outcome')
+    writer.remove('outcome_pois')
+    writer.set_attr('T', T)
+
+
+def write_events(path, r0, times, counts):
+    # event times of the rows r0:r0+len(counts), merged by merge_events
+    util_store.mkdir(path + 'parts/')
+    fname = path + 'parts/events_%d.npz' % r0
+    with open(fname + '.tmp', 'wb') as f:
+        np.savez(f, times=times, counts=counts)
+    os.replace(fname + '.tmp', fname)
+
+
+def merge_events(writer, chunks):
+    """
+    Concatenate the event times into 'event_times' [E] and 'event_offset'
+    [n_rows + 1]. A chunk comes from its part file if it has been
+    (re)processed and from the current arrays otherwise. The new arrays get
+    new file names, so a crash before the manifest is saved keeps the old ones.
+    """
+    path = writer.path
+    arrays = writer.manifest['arrays']
+    parts = {r0: path + 'parts/events_%d.npz' % r0 for r0, _ in chunks
+             if os.path.exists(path + 'parts/events_%d.npz' % r0)}
+    n_rows = chunks[-1][1] if len(chunks) > 0 else 0
+    if len(parts) == 0 and 'event_offset' in arrays \
+            and arrays['event_offset']['shape'][0] == n_rows + 1:
+        return
+    if 'event_offset' in arrays:
+        old_offset = np.array(writer.open('event_offset'))
+        old_times = writer.open('event_times')
+        old_files = [arrays[name]['file'] for name in ['event_times', 'event_offset']]
+    else:
+        old_files = []
+
+    counts = []
+    for r0, r1 in chunks:
+        if r0 in parts:
+            counts.append(np.load(parts[r0])['counts'])
+        else:
+            counts.append(np.diff(old_offset[r0:r1+1]))
+    offset = np.r_[0, np.cumsum(np.concatenate(counts))].astype(np.int64)
+
+    version = writer.manifest['attrs'].get('events_version', -1) + 1
+    times = writer.create('event_times', np.int16, [offset[-1]],
+                          fname='event_times.%d.bin' % version)
+    for r0, r1 in chunks:
+        if r0 in parts:
+            times[offset[r0]:offset[r1]] = np.load(parts[r0])['times']
+        else:
+            times[offset[r0]:offset[r1]] = old_times[old_offset[r0]:old_offset[r1]]
+    writer.create('event_offset', np.int64, [len(offset)],
+                  fname='event_offset.%d.bin' % version)[:] = offset
+    writer.set_attr('events_version', version)
+    writer.save()
+
+    for fname in old_files:
+        if os.path.exists(path + fname):
+            os.remove(path + fname)
+    for fname in parts.values():
+        os.remove(fname)
+
+
+def build_eval(writer, chunksize=64, force=False):
+    """
+    Curves of every (group, treatment) as one int16 array 'eval_mean'
+    [U, K, T], so that the evaluation block of a proportion group is a slice
+    (see SimulationStore.get_eval). A (group, treatment) without simulation
+    run is a zero curve. Skipped if the events, groups and T have not changed.
+    """
+    attrs = writer.manifest['attrs']
+    key = util_store.eval_key(attrs)
+    info = writer.manifest['arrays'].get('eval_mean')
+    if not force and info is not None and info['shape'][-1] == attrs['T'] \
+            and attrs.get('eval_key') == key:
+        return False
+    rows = np.array(writer.open('group_treatment_row'))
+    times, offset = writer.open('event_times'), writer.open('event_offset')
+    T = attrs['T']
+    U, K = rows.shape
+    # the curves are counts of at most n_seats agents
+    eval_mean = writer.create('eval_mean', np.int16, [U, K, T])
+    for u0 in tqdm(range(0, U, chunksize)):
+        _rows = rows[u0:u0 + chunksize].reshape(-1)
+        curve = util_outcome.times2curve(
+            *util_outcome.take_events(times, offset, _rows), T)
+        eval_mean[u0:u0 + chunksize] = curve.reshape(-1, K, T)
+    writer.set_attr('eval_key', key)
+    writer.save()
+    return True
+
+
 class ShinkokuDataset_y(Dataset):
-    def __init__(self, csv_file='source/y.csv', withtime=False):
+    def __init__(self, csv_file='source/y.csv', withtime=False, T=1289+1, chunksize=1000):
         dirpath = '../data/'
         self.dirpath = dirpath
         self.withtime = withtime
-        self.savedir = dirpath + 'data/y/'
-        mkdir(self.savedir)
-        
+        self.savedir = dirpath + 'data/store/'
+
+        writer = util_store.StoreWriter(self.savedir)
+        n_rows = writer.manifest['attrs']['n_rows']
+        create_store(writer, T)
+
         with open(dirpath + csv_file) as f:
             _seatname = f.readline().rstrip().split(',')
             self.seatname = get_seatname(_seatname)
 
-            for (c, l) in enumerate(tqdm(f)):
-                l = l.rstrip().split(',')
-                l.pop(0)
-                l_np = np.array(l)
-                l_np = l_np[l_np != ''].astype(float)
-
-                l_np.sort()
-                outcome = np.zeros(1289+1)
-                b = 0
-                for a in l_np:
-                    a = int(a)
-                    outcome[b:a] = outcome[b]
-                    outcome[a] = outcome[b]+1
-                    b = a
-                outcome[b:] = outcome[b]
-                
-                outcome_pois = np.random.poisson(outcome)
-                np.savetxt(self.savedir + '/outcome_' +
-                           str(c) + '.csv', outcome, delimiter=',')
-                np.savetxt(self.savedir + '/outcome_pois_' +
-                           str(c) + '.csv', outcome_pois, delimiter=',')
-
-
+        # event times of a whole chunk of rows at once
+        reader = pd.read_csv(dirpath + csv_file, chunksize=chunksize)
+        c = 0
+        chunks = []
+        for chunk in tqdm(reader, total=-(-n_rows // chunksize)):
+            times = chunk.iloc[:, 1:].to_numpy(dtype=float)
+            write_events(self.savedir, c, *util_outcome.get_events(times))
+            chunks.append((c, c + len(times)))
+            c += len(times)
+        merge_events(writer, chunks)
+        if 'group_treatment_row' in writer.manifest['arrays']:
+            build_eval(writer)
+        writer.close()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='transform output')
-    dataset = ShinkokuDataset_y()
+    parser.add_argument('--T', type=int, default=1289+1)
+    parser.add_argument('--chunksize', type=int, default=1000)
+    args = parser.parse_args()
+
+    dataset = ShinkokuDataset_y(T=args.T, chunksize=args.chunksize)
     print(0)
@@ -2,14 +2,19 @@
 # !/usr/bin/env python3
 from matplotlib import get_backend
 from matplotlib import use
-import pickle
 import pandas as pd
 import numpy as np
 
 from tqdm import tqdm
 from os import path, mkdir
+import os
+import sys
 import argparse
 from torch.utils.data import Dataset
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'util'))  # noqa
+import util_store  # noqa
+
 np.random.seed(seed=0)
 
 def get_seatname(_seatname):
@@ -82,6 +87,162 @@ def sample_guide(prop, a=2.0, Nguide=2):
     return treatment
 
 
+def get_guide_prop_sum(prop):
+    # guide_prop_sum of sample_guide for every row of prop [U, 7]
+    _seat = np.array([358, 851, 187, 300, 292, 354, 868])
+    _theater = _seat * (prop/10)
+    theater = np.c_[_theater[:, 0], _theater[:, 1] + _theater[:, 2],
+                    _theater[:, 3:]]
+    guide = theater[:, [0, 1, 1, 2, 2, 4, 4, 5, 5]]
+    guide[:, [3, 4]] += theater[:, [3, 3]]
+    return guide / guide.sum(1, keepdims=True)
+
+
+def sample_guide_gumbel(guide_prop_sum, gumbel, Nguide=4, a=1.0):
+    """
+    Vectorized sample_guide_multinomial for all groups at once.
+
+    Taking the Nguide largest a*p + Gumbel noise draws Nguide guides without
+    replacement with probability exp(a*p) / sum(exp(a*p)) at every draw, i.e.
+    the same distribution as np.random.choice(9, Nguide, p, replace=False).
+    guide_prop_sum, gumbel: [U, 9]
+    """
+    score = a*guide_prop_sum + gumbel
+    _treatment = np.argpartition(-score, Nguide - 1, axis=1)[:, :Nguide]
+    treatment = np.zeros_like(score)
+    np.put_along_axis(treatment, _treatment, 1, axis=1)
+    return treatment
+
+
+def treatment_code(treatment):
+    # treatment [..., 9] as a bitmask
+    return (np.asarray(treatment).astype(np.int64) << np.arange(9)).sum(-1)
+
+
+def find_rows(groups, group, code):
+    # row ids of (group, treatment bitmask) pairs
+    order = np.argsort(groups['treatment_code'])
+    pos = np.minimum(np.searchsorted(
+        groups['treatment_code'], code, sorter=order), len(order) - 1)
+    k = order[pos]
+    rows = groups['group_treatment_row'][group, k]
+    missing = (groups['treatment_code'][k] != code) | (rows < 0)
+    if missing.any():
+        raise ValueError('%d sampled treatments were not simulated' %
+                         missing.sum())
+    return rows
+
+
+def generate_factual(dirpath, groups, store, expids, alist=[0.0, 1.0], Nguide=4, dirname='guide4'):
+    """
+    Factual treatments of all expids and all a in one pass.
+
+    Every expid draws one Gumbel noise [U, 9] from its own Generator, which
+    is shared by all a. The outputs are the same files as ShinkokuDataset_z.
+    """
+    _type = 'multinomial'
+    pop_unique = groups['pop_unique']
+    guide_prop_sum = get_guide_prop_sum(pop_unique)
+    group = np.arange(len(pop_unique))
+    for expid in expids:
+        _savepath = '%s/dataset_%d/' % (dirpath, expid)
+        savepath = '%s/dataset_%d/%s/' % (dirpath, expid, dirname)
+        savedatapath = savepath + 'data/'
+        for dir in [_savepath, savepath, savedatapath]:
+            if not path.exists(dir):
+                mkdir(dir)
+
+        gumbel = np.random.default_rng(expid).gumbel(size=guide_prop_sum.shape)
+        for a in alist:
+            treatment = sample_guide_gumbel(
+                guide_prop_sum, gumbel, Nguide=Nguide, a=a)
+            factual_id = find_rows(groups, group, treatment_code(treatment))
+            # zの読み込みとtest
+            np.testing.assert_array_equal(
+                treatment, store.get_z(factual_id))
+            factual_id_inset = groups['row_inset'][factual_id]
+
+            np.savetxt('%s/factual_treatment_%s_a_%.1f.csv' %
+                       (savedatapath, _type, a), treatment)
+            np.savetxt('%s/factual_id_%s_a_%.1f.csv' %
+                       (savedatapath, _type, a), factual_id)
+            np.savetxt('%s/factual_id_inset_%s_a_%.1f.csv' %
+                       (savedatapath, _type, a), factual_id_inset)
+
+
+# arrays of the grouping index in the store
+group_names = ['pop_unique', 'group_offset', 'group_rows', 'row_group',
+               'row_inset', 'treatment_unique', 'row_treatment',
+               'treatment_code', 'group_treatment_row']
+
+
+def build_groups(pop, treatment):
+    """
+    Group the rows sharing the same proportion in one pass.
+
+    pop_unique [U, 7]        : unique proportions (sorted as np.unique)
+    group_rows [N]           : row ids sorted by group, ascending within a group
+    group_offset [U + 1]     : rows of group u are group_rows[offset[u]:offset[u+1]]
+    row_group [N]            : group of each row
+    row_inset [N]            : position of each row within its group
+    treatment_unique [K, 9]  : unique treatments
+    row_treatment [N]        : index of the treatment of each row
+    treatment_code [K]       : bitmask of treatment_unique
+    group_treatment_row [U, K] : row of (group, treatment), the first one if
+                               simulated twice and -1 if not simulated
+    """
+    pop = np.asarray(pop)
+    treatment = np.asarray(treatment)
+    pop_unique, row_group = np.unique(pop, axis=0, return_inverse=True)
+    row_group = row_group.reshape(-1)
+    group_rows = np.argsort(row_group, kind='stable')
+    group_offset = np.r_[0, np.cumsum(
+        np.bincount(row_group, minlength=len(pop_unique)))]
+    row_inset = np.empty(len(pop), dtype=np.int64)
+    row_inset[group_rows] = np.arange(len(pop)) - group_offset[row_group[group_rows]]
+    treatment_unique, row_treatment = np.unique(
+        treatment, axis=0, return_inverse=True)
+    row_treatment = row_treatment.reshape(-1)
+    group_treatment_row = np.full(
+        [len(pop_unique), len(treatment_unique)], len(pop), dtype=np.int64)
+    np.minimum.at(group_treatment_row, (row_group, row_treatment),
+                  np.arange(len(pop)))
+    group_treatment_row[group_treatment_row == len(pop)] = -1
+    return {'pop_unique': pop_unique.astype(np.float64),
+            'group_offset': group_offset.astype(np.int64),
+            'group_rows': group_rows.astype(np.int64),
+            'row_group': row_group.astype(np.int32),
+            'row_inset': row_inset.astype(np.int32),
+            'treatment_unique': treatment_unique.astype(np.uint8),
+            'row_treatment': row_treatment.astype(np.int32),
+            'treatment_code': treatment_code(treatment_unique),
+            'group_treatment_row': group_treatment_row}
+
+
+def load_groups(dirpath, pop, treatment, writer=None, rebuild=False):
+    # groups of rows sharing the same proportion (cached in the store)
+    if writer is None:
+        writer = util_store.StoreWriter(dirpath + 'data/store/')
+    arrays = writer.manifest['arrays']
+    if rebuild or not all(name in arrays for name in group_names) \
+            or arrays['group_rows']['shape'][0] != len(pop):
+        groups = build_groups(pop, treatment)
+        for name in group_names:
+            writer.create(name, groups[name].dtype,
+                          groups[name].shape)[:] = groups[name]
+        writer.close()
+    else:
+        groups = read_groups(writer)
+    return groups
+
+
+def read_groups(store):
+    # store: StoreWriter or SimulationStore
+    if isinstance(store, util_store.StoreWriter):
+        return {name: np.array(store.open(name)) for name in group_names}
+    return {name: np.array(store[name]) for name in group_names}
+
+
 class ShinkokuDataset_z(Dataset):
     def __init__(self, csv_file='source/x_z.csv', withtime=False, Nguide=4, dirname='data', expid=1):
         dirpath = '../data/'
@@ -90,7 +251,7 @@ class ShinkokuDataset_z(Dataset):
         self.dirpath = dirpath
         self.savepath = savepath
         self.savedatapath = savepath + 'data/'
-        self.xzpath = dirpath + 'data/xz/'
+        self.store = util_store.SimulationStore(dirpath + 'data/store/')
         self.withtime = withtime
 
         for dir in [_savepath, self.savepath, self.savedatapath]:
@@ -107,49 +268,16 @@ class ShinkokuDataset_z(Dataset):
         f = open(dirpath + 'source/y.csv')
         _seatname = f.readline().rstrip().split(',')
         self.seatname = get_seatname(_seatname)
-        self.seatname.to_csv(dirpath + 'data/seatname.csv')
+        if not path.exists(dirpath + 'data/seatname.csv'):
+            self.seatname.to_csv(dirpath + 'data/seatname.csv')
 
         # -------------------- #
-        # unique of proportion
-        if not path.exists(dirpath + 'data/pop_unique.csv'):
-            self.pop_unique = np.unique(self.pop, axis=0)
-            np.savetxt(dirpath + 'data/pop_unique.csv',
-                       self.pop_unique, delimiter=',')
-        else:
-            self.pop_unique = np.loadtxt(
-                dirpath + 'data/pop_unique.csv', delimiter=',')
-
-        # index for same covariate
-        if not path.exists(dirpath + 'data/pop_same.pkl'):
-            same_pop = []
-            for _pop_unique in self.pop_unique:
-                _same_pop = np.where((self.pop == _pop_unique).all(axis=1))[0]
-                same_pop.append(_same_pop)
-            with open(dirpath + 'data/pop_same.pkl', 'wb') as f:
-                pickle.dump(same_pop, f)
-        else:
-            with open(dirpath + 'data/pop_same.pkl', 'rb') as f:
-                same_pop = pickle.load(f)
-
-        # unique of intervention
-        if not path.exists(dirpath + 'data/treatment_unique.csv'):
-            self.treatment_unique = np.unique(self.treatment, axis=0)
-            np.savetxt(dirpath + 'data/treatment_unique.csv',
-                       self.treatment_unique, delimiter=',')
-        else:
-            self.treatment_unique = np.loadtxt(
-                dirpath + 'data/treatment_unique.csv', delimiter=',')
-
-        if not path.exists(dirpath + 'data/pop_to_index.csv'):
-            self.covariate_index = [[] for _ in range(len(self.pop_unique))]
-            for (i, _pop) in enumerate(self.pop_unique):
-                _id = np.where((self.pop == _pop).all(axis=1))[0]
-                self.covariate_index[i] = _id
-            np.savetxt(dirpath + 'data/pop_to_index.csv',
-                       np.array(self.covariate_index), delimiter=',')
-        else:
-            self.covariate_index = np.loadtxt(
-                dirpath + 'data/pop_to_index.csv', delimiter=',')
+        groups = load_groups(dirpath, self.pop, self.treatment)
+        self.pop_unique = groups['pop_unique']
+        self.treatment_unique = groups['treatment_unique']
+        same_pop = np.split(groups['group_rows'], groups['group_offset'][1:-1])
+        # treatment of a row as a key of treatment_unique
+        treatment_index = {tuple(t): k for k, t in enumerate(self.treatment_unique)}
 
         print('done')
         # -------------------- #
@@ -163,9 +291,6 @@ class ShinkokuDataset_z(Dataset):
         factual_id = []
         factual_id_inset = []
         for _prop, _id in zip(tqdm(self.pop_unique), same_pop):
-            # セット(同一使用率)のIDから介入を取得
-            same_pop_treatment = self.treatment.iloc[_id, :]
-
             # 誘導(介入)のサンプリング
             _treatment = sample_guide(
                 _prop, a=a, Nguide=Nguide)
@@ -173,16 +298,13 @@ class ShinkokuDataset_z(Dataset):
             treatment.append(_treatment)
 
             # 選択された使用率の介入のIDを取得
-            _factual_inset = np.where(
-                (same_pop_treatment == _treatment).all(axis=1))[0]
-            _factual_id = _id[_factual_inset]
+            _k = treatment_index[tuple(_treatment.astype(np.uint8))]
+            _factual_id = _id[groups['row_treatment'][_id] == _k]
+            _factual_inset = groups['row_inset'][_factual_id]
 
             # zの読み込みとtest
-            fname = self.xzpath + 'xz_' + str(_factual_id[0]) + '.pkl'
-            with open(fname, 'rb') as f:
-                xzsp = pickle.load(f)
-            np.testing.assert_almost_equal(
-                0, (_treatment - xzsp.toarray()[0, -9:]).sum())
+            z = self.store.get_z(_factual_id[0])
+            np.testing.assert_almost_equal(0, (_treatment - z).sum())
 
             # セット内でのidのリスト
             factual_id_inset.append(_factual_inset)
@@ -207,7 +329,20 @@ class ShinkokuDataset_z(Dataset):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='sample intervention')
     parser.add_argument('--expid', type=int, default=0)
+    parser.add_argument('--expids', type=str, default=None,
+                        help='e.g. 0,1,2: all expids in one vectorized pass')
+    parser.add_argument('--alist', type=str, default='0.0,1.0')
     args = parser.parse_args()
 
-    dataset = ShinkokuDataset_z(Nguide=4, dirname='guide4', expid=args.expid)
+    if args.expids is None:
+        dataset = ShinkokuDataset_z(Nguide=4, dirname='guide4', expid=args.expid)
+    else:
+        dirpath = '../data/'
+        data = pd.read_csv(dirpath + 'source/x_z.csv')
+        groups = load_groups(dirpath, data.iloc[:, :7], data.iloc[:, 7:16])
+        store = util_store.SimulationStore(dirpath + 'data/store/')
+        generate_factual(dirpath, groups, store,
+                         [int(x) for x in args.expids.split(',')],
+                         [float(x) for x in args.alist.split(',')],
+                         Nguide=4, dirname='guide4')
     print(0)
@@ -1,9 +1,13 @@
 #!/bin/bash
-python preproc_x.py
-python preproc_xz.py
-python preproc_y.py
+# all stages on a process pool (see python preproc_all.py -h)
+python preproc_all.py
 
-for i in {0..9} ; do
-    python preproc_z.py --expid ${i} # select factual treatment
-    python preproc_sample.py --expid ${i} # split train and test
-done
+# serial version
+# python preproc_x.py
+# python preproc_xz.py
+# python preproc_y.py
+#
+# python preproc_z.py --expids 0,1,2,3,4,5,6,7,8,9 # select factual treatment (a=0.0,1.0)
+# for i in {0..9} ; do
+#     python preproc_sample.py --expid ${i} # split train and test
+# done
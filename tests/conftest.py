@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the modules import each other by name from util/ and preprocess/
+root = os.path.join(os.path.dirname(__file__), '..')
+for path in ['util', 'preprocess']:
+    sys.path.append(os.path.join(root, path))
@@ -0,0 +1,33 @@
+import os
+import shutil
+
+import pandas as pd
+
+import util_graph
+
+root = os.path.join(os.path.dirname(__file__), '..')
+
+
+def make_source(path):
+    os.mkdir(path + 'source/')
+    for fname in ['node_coord.csv', 'node_node_distance_edit.csv']:
+        shutil.copy(os.path.join(root, 'data/source', fname), path + 'source/')
+    return pd.read_csv(os.path.join(root, 'data/source/seatname.csv'),
+                       index_col=0, dtype=str)
+
+
+def test_graph_key(tmp_path, monkeypatch):
+    path = str(tmp_path) + '/'
+    seatname = make_source(path)
+    key = util_graph.graph_key(path, seatname, False)
+    # the same inputs and version give the same key
+    assert util_graph.graph_key(path, seatname, False) == key
+    assert util_graph.graph_key(path, seatname, True) != key
+    assert util_graph.graph_key(path, seatname.iloc[1:], False) != key
+    # bumping the version invalidates the key of unchanged inputs
+    monkeypatch.setattr(util_graph, 'GRAPH_VERSION', util_graph.GRAPH_VERSION + 1)
+    assert util_graph.graph_key(path, seatname, False) != key
+    monkeypatch.undo()
+    with open(path + 'source/node_coord.csv', 'a') as f:
+        f.write('\n')
+    assert util_graph.graph_key(path, seatname, False) != key
@@ -0,0 +1,51 @@
+import threading
+
+import pytest
+import torch
+
+import util_dataloader
+
+
+class Loader():
+    # n batches, records whether its iterator has been closed
+    def __init__(self, n, fail=None):
+        self.n = n
+        self.fail = fail
+        self.closed = threading.Event()
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        try:
+            for i in range(self.n):
+                if i == self.fail:
+                    raise ValueError('batch %d' % i)
+                yield {'x': torch.full((2,), float(i)), 'name': i}
+        finally:
+            self.closed.set()
+
+
+def test_order():
+    loader = Loader(10)
+    batches = list(util_dataloader.Prefetcher(loader, 'cpu', depth=2))
+    assert [b['name'] for b in batches] == list(range(10))
+    assert all(torch.equal(b['x'], torch.full((2,), float(i))) for i, b in enumerate(batches))
+
+
+def test_early_break_stops_thread():
+    n_threads = threading.active_count()
+    loader = Loader(100)
+    it = iter(util_dataloader.Prefetcher(loader, 'cpu', depth=2))
+    assert next(it)['name'] == 0
+    it.close()
+    assert loader.closed.wait(5)
+    assert threading.active_count() == n_threads
+
+
+def test_error():
+    n_threads = threading.active_count()
+    with pytest.raises(ValueError):
+        for batch in util_dataloader.Prefetcher(Loader(10, fail=3), 'cpu', depth=2):
+            pass
+    assert threading.active_count() == n_threads
@@ -0,0 +1,61 @@
+import os
+from collections.abc import Mapping
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import util_seatgraph
+
+root = os.path.join(os.path.dirname(__file__), '..')
+
+# graph_digest of the graphs of data/source/seatname.csv built with the
+# linear scans of the builders before group_rows / index_rowcol
+DIGEST = 'd28a2a34514a40c8a11a3154a99fd7cc3ecd874e3708dc291ebb40ad31b89066'
+
+
+class Scan(Mapping):
+    # the lookups of the old builders, a scan of idrowcol on every access
+    def __init__(self, idrowcol, key, first):
+        self.idrowcol, self.key, self.first = idrowcol, key, first
+
+    def __getitem__(self, k):
+        nodes = [x for x in self.idrowcol if self.key(x) == k]
+        if not nodes:
+            raise KeyError(k)
+        return nodes[0] if self.first else nodes
+
+    def __iter__(self):
+        return iter(dict.fromkeys(self.key(x) for x in self.idrowcol))
+
+    def __len__(self):
+        return len(dict.fromkeys(self.key(x) for x in self.idrowcol))
+
+
+def graphs(getseatgraph):
+    return [getseatgraph.oh1f, getseatgraph.oh2f, getseatgraph.oh3f,
+            getseatgraph.oh4f, getseatgraph.ph, getseatgraph.tf]
+
+
+@pytest.fixture(scope='module')
+def seatname():
+    return pd.read_csv(os.path.join(root, 'data/source/seatname.csv'),
+                       index_col=0, dtype={'row': str, 'col': str})
+
+
+@pytest.mark.parametrize('withtime', [False, True])
+def test_digest(seatname, withtime):
+    getseatgraph = util_seatgraph.GetSeatGraph(seatname, withtime)
+    assert util_seatgraph.graph_digest(getseatgraph) == DIGEST
+
+
+def test_index_as_scan(seatname, monkeypatch):
+    new = graphs(util_seatgraph.GetSeatGraph(seatname))
+    monkeypatch.setattr(util_seatgraph, 'group_rows', lambda idrowcol: Scan(
+        idrowcol, lambda x: x['row'], False))
+    monkeypatch.setattr(util_seatgraph, 'index_rowcol', lambda idrowcol: Scan(
+        idrowcol, lambda x: (x['row'], x['col']), True))
+    old = graphs(util_seatgraph.GetSeatGraph(seatname))
+    for g_new, g_old in zip(new, old):
+        assert list(g_new.G.nodes) == list(g_old.G.nodes)
+        np.testing.assert_array_equal(g_new.W, g_old.W)
@@ -0,0 +1,116 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import util_store
+import util_outcome
+import util_dataloader
+import preproc_y
+
+
+def make_store(path, T, seed=0):
+    # 6 rows of 2 groups x 3 treatments with random event times
+    rng = np.random.RandomState(seed)
+    writer = util_store.StoreWriter(str(path) + '/')
+    counts = rng.randint(0, 20, size=6)
+    offset = np.r_[0, np.cumsum(counts)]
+    writer.create('event_times', np.int16, [offset[-1]])[:] = rng.randint(0, 40, size=offset[-1])
+    writer.create('event_offset', np.int64, [len(offset)])[:] = offset
+    writer.create('group_treatment_row', np.int64, [2, 3])[:] = \
+        np.array([[0, 1, 2], [3, -1, 5]])
+    writer.set_attr('events_version', 0)
+    writer.set_attr('groups_hash', 'h')
+    preproc_y.create_store(writer, T)
+    writer.save()
+    return writer
+
+
+def check_eval(path, T):
+    store = util_store.SimulationStore(str(path) + '/')
+    assert store.has_eval()
+    for group in range(2):
+        rows = store.get_rows(group, np.arange(3))
+        curve = store.get_eval(group, np.arange(3))
+        assert curve.shape == (3, T)
+        expect = store.get_outcome(np.maximum(rows, 0))
+        expect[rows < 0] = 0
+        np.testing.assert_array_equal(curve, expect)
+
+
+def test_eval_follows_T(tmp_path):
+    writer = make_store(tmp_path, 30)
+    assert preproc_y.build_eval(writer)
+    assert not preproc_y.build_eval(writer)
+    check_eval(tmp_path, 30)
+
+    # the y stage rerun with another --T
+    preproc_y.create_store(writer, 50)
+    writer.save()
+    assert not util_store.SimulationStore(str(tmp_path) + '/').has_eval()
+    assert preproc_y.build_eval(writer)
+    check_eval(tmp_path, 50)
+
+
+def get_curves(store, eval_block, rows, group, noise=None, step=1):
+    # ShinkokuDataset.get_curves without the context of the run
+    dataset = SimpleNamespace(
+        store=store, eval_block=eval_block, treatment_k=np.arange(3), noise=noise,
+        noise_seed=0, step=step, T=-(-store.attrs['T'] // step))
+    return util_dataloader.ShinkokuDataset.get_curves(dataset, rows, group)
+
+
+def test_missing_rows(tmp_path):
+    make_store(tmp_path, 30)
+    store = util_store.SimulationStore(str(tmp_path) + '/')
+    rows = np.array([3, -1, 5])
+    for pois in [False, True]:
+        curve = store.get_outcome(rows, pois=pois, replicate=1)
+        np.testing.assert_array_equal(curve[1], 0)
+        np.testing.assert_array_equal(curve[[0, 2]], store.get_outcome(
+            rows[[0, 2]], pois=pois, replicate=1))
+    np.testing.assert_array_equal(store.get_outcome(-1), 0)
+    with pytest.raises(ValueError):
+        util_outcome.poisson_noise(np.ones((1, 30)), [-1])
+
+
+def test_curves_missing_rows(tmp_path):
+    # the evaluation blocks and the event times agree on the rows -1
+    writer = make_store(tmp_path, 30)
+    preproc_y.build_eval(writer)
+    store = util_store.SimulationStore(str(tmp_path) + '/')
+    group = np.arange(2)[:, None]
+    rows = store.get_rows(group, np.arange(3))
+    for noise in [None, 1]:
+        curves = [get_curves(store, eval_block, rows, group, noise=noise)
+                  for eval_block in [False, True]]
+        for a, b in zip(*curves):
+            np.testing.assert_array_equal(a, b)
+            np.testing.assert_array_equal(a[rows < 0], 0)
+
+
+@pytest.mark.parametrize('step', [1, 4, 7])
+def test_step(tmp_path, step):
+    # the curves at step seconds per time step from the evaluation blocks,
+    # the store and the collated event times
+    writer = make_store(tmp_path, 30)
+    preproc_y.build_eval(writer)
+    store = util_store.SimulationStore(str(tmp_path) + '/')
+    T = -(-30 // step)
+    group = np.arange(2)[:, None]
+    rows = store.get_rows(group, np.arange(3))
+    full = store.get_eval(group, np.arange(3))
+    for eval_block in [False, True]:
+        m = get_curves(store, eval_block, rows, group, step=step)[1]
+        assert m.shape == (2, 3, T)
+        np.testing.assert_array_equal(m, full[..., ::step])
+    batch = []
+    for r in rows:
+        times, offset = store.get_times(r)
+        batch.append({'times': times, 'times_offset': offset,
+                      'times_shape': (3,), 'T': T, 'step': step})
+    data = util_dataloader.collate_times(batch)
+    m = util_outcome.times2curve(
+        data['times'], data['times_offset'], data['T'], data['step'])
+    np.testing.assert_array_equal(
+        m.reshape(data['times_shape'] + [-1]).numpy(), full[..., ::step])
@@ -4,17 +4,23 @@ import os
 import subprocess
 import argparse
 import torch
-import pickle
 import numpy as np
 import pandas as pd
 from multiprocessing import Manager, Pool
 from copy import copy
 from tqdm import tqdm
 import time
+import threading
+from queue import Queue, Full
+from collections import deque
 
 import util_graph
 import util_seatgraph
+import util_store
+import util_outcome
 from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import BatchSampler, RandomSampler, SequentialSampler
+from torch.utils.data.dataloader import default_collate
 from sklearn.preprocessing import MinMaxScaler
 
 import matplotlib as mpl
@@ -40,22 +46,11 @@ def ShinkokuDatasetSize(a=10.0, individual=False):
     return treatment.shape[0]
 
 
-def test_samepop(same_pop, xzpath, unique):
+def test_samepop(same_pop, store, unique):
     Zlist = []
     for i, id in enumerate(same_pop):
-        _XZ = []
-        for _id in id:
-            fname = xzpath + 'xz_' + str(_id) + '.pkl'
-            with open(fname, 'rb') as f:
-                xz = pickle.load(f).toarray()[0]
-            x = xz[:-9]
-            x[x != 0] = 1 
-            z = xz[-9:]
-            _XZ.append(xz)
-
-        XZ = np.c_[_XZ]
-        X = XZ[:, :-9]
-        Z = XZ[:, -9:]
+        X = store.get_x(id)
+        Z = store.get_z(id)
 
         if len(np.unique(X, axis=0)) != 1:
             print('error')
@@ -73,18 +68,8 @@ def test_samepop(same_pop, xzpath, unique):
     print(0)
 
 
-def get_unique(same_pop, xzpath):
-    _XZ = []
-    id = same_pop[0]
-    for _id in id:
-        fname = xzpath + 'xz_' + str(_id) + '.pkl'
-        with open(fname, 'rb') as f:
-            xz = pickle.load(f).toarray()[0]
-        _XZ.append(xz)
-
-    XZ = np.c_[_XZ]
-    Z = XZ[:, -9:]
-
+def get_unique(same_pop, store):
+    Z = store.get_z(same_pop[0])
     return Z
 
 
@@ -96,31 +81,253 @@ def transform_samepop_treatment_unizue(_same_pop, _treatment_unique, Nguide):
     return same_pop, treatment_id, treatment_unique
 
 
-class ShinkokuDataset(Dataset):
-    def __init__(self, csv_file='each_seat_1_0.csv', withtime=False, a=10.0, individual=False, Nguide=2, mode='train', id='', expid=0, obs_prop=0.0):
+def load_traintest(dirpath, expid, traintest):
+    """
+    Train and test proportion ids of a split (e.g. rand_50, strat_50, extra_50),
+    from the store if it has the split and from the csv files otherwise.
+    """
+    store = util_store.SimulationStore(dirpath + 'data/store/')
+    if 'split_' + traintest in store:
+        split = np.array(store['split_' + traintest][expid])
+        return np.where(split == 1)[0], np.where(split == 0)[0]
+    traintestpath = '%s/dataset_%d/traintest_%s/' % (dirpath, expid, traintest)
+    return (np.loadtxt('%s/prop_train_id.csv' % (traintestpath)),
+            np.loadtxt('%s/prop_test_id.csv' % (traintestpath)))
+
+
+def batch_loader(dataset, batch_size, shuffle=False, drop_last=False, num_workers=2,
+                 pin_memory=False):
+    """
+    DataLoader of whole batches: a BatchSampler passes the index list of a
+    batch to ShinkokuDataset.get_batch, so there is no per-sample fetch and
+    no collate.
+    """
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last),
+                      batch_size=None, num_workers=num_workers, pin_memory=pin_memory)
+
+
+class Prefetcher():
+    """
+    Iterates over a loader with the next batches already on the device.
+
+    On CUDA the copies of the next `depth` batches are issued non-blocking
+    on a side stream while the current step runs (they only overlap if the
+    loader pins its batches, batch_loader(pin_memory=True)), on CPU a
+    background thread fetches them. The batches are the dicts of the
+    loader, so the .to(device) of the model become no-ops.
+    """
+
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.loader)
+
+    def to_device(self, batch):
+        out = {}
+        for key, value in batch.items():
+            if torch.is_tensor(value):
+                value = value.to(device=self.device, non_blocking=True)
+            out[key] = value
+        return out
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            return self.iter_cuda()
+        return self.iter_thread()
+
+    def iter_cuda(self):
+        stream = torch.cuda.Stream(device=self.device)
+        it = iter(self.loader)
+        queue = deque()
+
+        def load():
+            batch = next(it, None)
+            if batch is not None:
+                with torch.cuda.stream(stream):
+                    queue.append(self.to_device(batch))
+            return batch is not None
+
+        while len(queue) < self.depth and load():
+            pass
+        while len(queue) > 0:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(stream)
+            batch = queue.popleft()
+            for value in batch.values():
+                if torch.is_tensor(value):
+                    # the memory was allocated on the side stream
+                    value.record_stream(current)
+            load()
+            yield batch
+
+    def iter_thread(self):
+        queue = Queue(maxsize=self.depth)
+        end = object()
+        # set when the consumer stops, also before the end of the loader
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def worker():
+            try:
+                for batch in self.loader:
+                    if not put({key: value.to(device=self.device)
+                                if torch.is_tensor(value) else value
+                                for key, value in batch.items()}):
+                        # releases the loader iterator and its workers
+                        return
+                put(end)
+            except Exception as e:
+                put(e)
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = queue.get()
+                if batch is end:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            while not queue.empty():
+                queue.get_nowait()
+            thread.join()
+
+
+class DeviceLoader():
+    """
+    Loader of a whole split resident on the device.
+
+    The samples are uploaded once and every epoch is an index permutation on
+    the device, so a batch is an index into device tensors without workers
+    or host to device copies. Iterates over the same batch dicts as
+    batch_loader (event times are expanded to the curves at upload).
+    """
+
+    def __init__(self, dataset, batch_size, shuffle=False, drop_last=False, device='cpu'):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.device = device
+        self.n = len(dataset)
+
+        data = dataset.preloaded.get(dataset.mode)
+        if data is None:
+            data = dataset.load_batch(np.arange(self.n))
+        times = {key: data[key] for key in ['times', 'times_offset'] if key in data}
+        self.data = {key: value.to(device=device) for key, value in data.items()
+                     if key not in times}
+        if len(times) > 0:
+            m = util_outcome.times2curve(
+                torch.as_tensor(times['times']).to(device=device),
+                torch.as_tensor(times['times_offset']), dataset.T, dataset.step)
+            m = m.reshape([self.n] + list(dataset.rows_shape()) + [-1])
+            self.data['mean'] = m
+            self.data.setdefault('outcome', m)
+        # factual samples without observation mask
+        self.mask = dataset.mode == 'train' and 'mask' not in self.data
+
+    def __len__(self):
+        if self.drop_last:
+            return self.n // self.batch_size
+        return -(-self.n // self.batch_size)
+
+    def __iter__(self):
+        if self.shuffle:
+            perm = torch.randperm(self.n, device=self.device)
+        else:
+            perm = torch.arange(self.n, device=self.device)
+        for b in range(len(self)):
+            idx = perm[b*self.batch_size:(b+1)*self.batch_size]
+            batch = {key: value[idx] for key, value in self.data.items()}
+            if self.mask:
+                batch['mask'] = []
+            yield batch
+
+
+def collate_times(batch):
+    """
+    collate_fn for ShinkokuDataset(outcome_times=True).
+
+    The ragged event times of the batch are concatenated into 'times' with
+    their row offsets 'times_offset'. The curves are expanded later on the
+    device by util_outcome.times2curve (see Proto.data2outcome), with shape
+    'times_shape' + [T] at 'step' seconds per time step.
+    """
+    times = [sample.pop('times') for sample in batch]
+    offset = [sample.pop('times_offset') for sample in batch]
+    T, step = batch[0].pop('T'), batch[0].pop('step')
+    shape = [len(batch)] + list(batch[0].pop('times_shape'))
+    for sample in batch[1:]:
+        for key in ['T', 'step', 'times_shape']:
+            sample.pop(key)
+    data = default_collate(batch)
+    counts = np.concatenate([np.diff(o) for o in offset])
+    data['times'] = torch.from_numpy(np.concatenate(times))
+    data['times_offset'] = torch.from_numpy(np.r_[0, np.cumsum(counts)])
+    data['times_shape'] = shape
+    data['T'] = T
+    data['step'] = step
+    return data
+
+
+def worker_state(state):
+    """
+    Pickled state of ShinkokuContext / ShinkokuDataset for DataLoader workers.
+    The workers only index arrays: the graphs and pandas frames are dropped,
+    a GetSeatGraph is reduced to util_seatgraph.SeatBits, the store is
+    reopened from its path and the preloaded tensors are in shared memory.
+    """
+    state = state.copy()
+    for key in ['graph', 'node', 'edge', 'seatname', 'A', 'W']:
+        state[key] = None
+    if isinstance(state['getseatgraph'], util_seatgraph.GetSeatGraph):
+        state['getseatgraph'] = util_seatgraph.SeatBits(state['getseatgraph'].index)
+    return state
+
+
+class ShinkokuContext():
+    """
+    Read-only data shared by the ShinkokuDataset of one run (store, seat and
+    venue graphs, factual ids, test treatments). Build it once and pass it
+    to every split with ShinkokuDataset(context=...).
+    """
+
+    def __init__(self, withtime=False, a=10.0, individual=False, Nguide=2, expid=0):
         dirpath = './data/'
         treatpath = dirpath + 'dataset_' + \
             str(expid) + '/guide' + str(Nguide) + '/'
 
         self.dirpath = dirpath
-        self.xzpath = dirpath + 'data/xz/'
+        self.store = util_store.SimulationStore(dirpath + 'data/store/')
         self.treatpath = treatpath
         self.withtime = withtime
-        # self.train = train
-        self.mode = mode
-        self.id = id
-        self.obs_prop = obs_prop
 
         # ------------------- #
-        f = open(dirpath + 'source/y.csv')
-        _seatname = f.readline().rstrip().split(',')
+        with open(dirpath + 'source/y.csv') as f:
+            _seatname = f.readline().rstrip().split(',')
         self.seatname = get_seatname(_seatname)
 
-        with open(self.dirpath + 'data/pop_same.pkl', 'rb') as f:
-            self.same_pop = pickle.load(f)
-
-        self.getseatgraph = util_seatgraph.GetSeatGraph(
-            self.seatname, self.withtime)
+        # normalized adjacency of the route graph A and the seat graphs W,
+        # built once and then read from data/graph_cache/
+        graphs = util_graph.load_graphs(dirpath, self.seatname, self.withtime)
+        self.A = graphs['A']
+        self.W = graphs['W']
+        self.getseatgraph = util_seatgraph.SeatBits(util_seatgraph.VenueIndex(
+            [c.numpy() for c in graphs['covariate_id']]))
         # ------------------- #
 
         # ------------------- #
@@ -140,21 +347,22 @@ class ShinkokuDataset(Dataset):
         # ------------------- #
 
         # ------------------- #
-        self.treatment_unique = np.loadtxt(
-            self.dirpath + 'data//treatment_unique.csv', delimiter=',')
-        # ------------------- #
-        self.treatment_unique = get_unique(self.same_pop, self.xzpath)
-
-        # ------------------- #
-        self.same_pop, self.treatment_id, self.treatment_unique = transform_samepop_treatment_unizue(
-            self.same_pop, self.treatment_unique, Nguide)
+        # treatments of the test block in the row order of the first group
+        first = self.store.get_group(0)
+        self.treatment_unique = self.store.get_z(first)
+        self.treatment_id = self.treatment_unique.sum(1) == Nguide
+        self.treatment_unique = self.treatment_unique[self.treatment_id]
+        # their columns of the (group, treatment) -> row table
+        self.treatment_k = np.array(
+            self.store['row_treatment'][first[self.treatment_id]])
+        # curves of the test treatments are precomputed per group
+        self.eval_block = self.store.has_eval()
 
         self.imgname = ['oh1f', 'oh2f', 'oh3f', 'oh4f', 'ph1f', 'ph2f', 'tf']
         node = pd.read_csv(dirpath + 'source/node_coord.csv')
         edge = pd.read_csv(dirpath + 'source/node_node_distance_edit.csv')
         self.node = node
         self.edge = edge
-        self.graph = util_graph.Graph(node, edge)
 
         self.guide = ['J_TP', 'J_PH_2F_l', 'J_PH_2F_r', 'J_OH_2F_l',
                       'J_OH_2F_r', 'J_OH_3F_l', 'J_OH_3F_r', 'J_OH_4F_l', 'J_OH_4F_r']
@@ -164,6 +372,47 @@ class ShinkokuDataset(Dataset):
         self.guide_node = scaler.transform(self.guide_node)
         # ------------------- #
 
+    def __getstate__(self):
+        return worker_state(self.__dict__)
+
+
+class ShinkokuDataset(Dataset):
+    def __init__(self, csv_file='each_seat_1_0.csv', withtime=False, a=10.0, individual=False, Nguide=2, mode='train', id='', expid=0, obs_prop=0.0, outcome_times=False, noise=None, noise_seed=0, preload=False, context=None, prop_k=0, step=1):
+        # shared data of the run, the dataset is a view of the split id
+        if context is None:
+            context = ShinkokuContext(withtime, a, individual, Nguide, expid)
+        self.context = context
+        self.__dict__.update(vars(context))
+
+        # self.train = train
+        self.mode = mode
+        self.id = id
+        self.obs_prop = obs_prop
+        # return event times instead of curves (use collate_times)
+        self.outcome_times = outcome_times
+        # replicate of the poisson noise of 'outcome' ('mean' stays noiseless)
+        self.noise = noise
+        self.noise_seed = noise_seed
+        # seconds per time step of the curves, T of them (see times2curve)
+        self.step = step
+        self.T = -(-self.store.attrs['T'] // step)
+        # hops of the propagated occupancy 'xprop' (see preproc_xz.build_prop)
+        self.prop_k = prop_k
+        if prop_k > 0 and not self.store.has_prop(
+                util_graph.graph_key(self.dirpath, self.seatname, self.withtime), prop_k):
+            raise FileNotFoundError(
+                'no propagated occupancy of %d hops up to date in the store, '
+                'run the prop stage of preproc_all.py first' % prop_k)
+        # all samples of a mode in memory, __getitem__ is an index
+        self.preload = preload
+        self.preloaded = {}
+
+        if self.preload:
+            self.preloaded[self.mode] = self.load_all()
+
+    def __getstate__(self):
+        return worker_state(self.__dict__)
+
     def __len__(self):
         if type(self.id) == np.array:
             return len(self.facutual_id)
@@ -171,6 +420,11 @@ class ShinkokuDataset(Dataset):
             return len(self.id)
 
     def __getitem__(self, idx):
+        if np.ndim(idx) != 0:
+            # index list of a BatchSampler
+            return self.get_batch(idx)
+        if self.preload:
+            return self.get_preloaded(idx)
         if self.mode == 'train':
             sample = self.get_train(idx)
         elif self.mode == 'valid':
@@ -192,25 +446,162 @@ class ShinkokuDataset(Dataset):
     def get_traintest(self):
         return self.mode
 
+    def get_curves(self, rows, group=None):
+        """
+        Outcome (noisy if noise is set) and mean [..., T] of the store rows.
+        The treatment set of test groups is a slice of the evaluation blocks
+        (group: group ids broadcastable with treatment_k). Both are zero,
+        without noise, for the rows -1 of the treatments not simulated.
+        """
+        rows = np.asarray(rows)
+        if group is not None and self.eval_block:
+            # the blocks are at one second per step
+            m = self.store.get_eval(group, self.treatment_k)[..., ::self.step]
+        else:
+            m = self.store.get_outcome(rows.reshape(-1), T=self.T, step=self.step)
+            m = m.reshape(rows.shape + (-1,))
+        if self.noise is None:
+            return m, m
+        y = m.reshape(-1, m.shape[-1]).copy()
+        _rows = rows.reshape(-1)
+        keep = _rows >= 0
+        y[keep] = util_outcome.poisson_noise(
+            y[keep], _rows[keep], self.noise, self.noise_seed)
+        return y.reshape(m.shape), m
+
+    def set_outcome(self, sample, idx, group=None):
+        # outcome and mean of rows idx (one row or a block of rows)
+        if self.outcome_times:
+            times, offset = self.store.get_times(idx)
+            sample.update({'times': times, 'times_offset': offset,
+                           'times_shape': np.shape(idx), 'T': self.T, 'step': self.step})
+            if self.noise is not None:
+                sample['outcome'] = self.get_curves(idx, group)[0]
+        else:
+            sample['outcome'], sample['mean'] = self.get_curves(idx, group)
+        return sample
+
+    def rows_shape(self):
+        # store rows of one sample
+        return () if self.mode != 'test' else (len(self.treatment_k),)
+
+    def load_batch(self, idx):
+        """
+        Covariates, treatments and outcomes of the positions idx of the
+        current mode as contiguous float32 tensors [len(idx), ...].
+        The event times (outcome_times) are returned as numpy arrays
+        'times' / 'times_offset' of the len(idx)*R rows of the samples.
+        """
+        ids = np.asarray(self.id)[idx].astype(int)
+        if self.mode == 'test':
+            # [len, K] rows of the treatment set of each group
+            rows = self.store.get_rows(ids[:, None], self.treatment_k[None])
+            x = self.store.get_x_packed(ids, group=True)
+            z = np.repeat(self.treatment_unique[None], len(ids), axis=0)
+        else:
+            factual_id = self.facutual_id if self.mode == 'train' else self.valid_id
+            rows = factual_id[ids].astype(int)
+            x = self.store.get_x_packed(rows)
+            z = self.store.get_z(rows)
+        imgs = self.getseatgraph.get(x, packed=True)
+
+        data = dict(zip(['oh1f', 'oh2f', 'oh3f', 'oh4f', 'ph', 'tf'], imgs))
+        data['treatment'] = z
+        if self.prop_k > 0:
+            data['xprop'] = self.store.get_prop(
+                ids if self.mode == 'test' else rows, self.prop_k, group=self.mode == 'test')
+        group = ids[:, None] if self.mode == 'test' else None
+        if self.outcome_times:
+            times, offset = self.store.get_times(rows.reshape(-1))
+            if self.noise is not None:
+                data['outcome'] = self.get_curves(rows, group)[0]
+        else:
+            data['outcome'], data['mean'] = self.get_curves(rows, group)
+        data = {key: torch.from_numpy(np.ascontiguousarray(value, dtype=np.float32))
+                for key, value in data.items()}
+
+        if self.mode == 'train' and self.obs_prop != 0.0:
+            mask = [np.loadtxt(self.dirpath + 'data/mask/mask_' + str(row) + '.csv',
+                               delimiter=',') for row in rows]
+            data['mask'] = torch.from_numpy(
+                (np.stack(mask) < self.obs_prop).astype(int))
+        if self.outcome_times:
+            data['times'] = times
+            data['times_offset'] = offset
+        return data
+
+    def load_all(self):
+        # every sample of the current mode (preload=True), in shared memory
+        # so that the DataLoader workers attach to it without a copy
+        data = self.load_batch(np.arange(len(self)))
+        if self.outcome_times:
+            data['times'] = torch.from_numpy(data['times'])
+            data['times_offset'] = torch.from_numpy(data['times_offset'])
+        for value in data.values():
+            value.share_memory_()
+        return data
+
+    def get_preloaded(self, idx):
+        if self.mode not in self.preloaded:
+            self.preloaded[self.mode] = self.load_all()
+        data = self.preloaded[self.mode]
+
+        sample = {key: value[idx] for key, value in data.items()
+                  if key not in ['times', 'times_offset']}
+        if self.mode == 'train' and 'mask' not in sample:
+            sample['mask'] = []
+        if self.outcome_times:
+            shape = self.rows_shape()
+            R = int(np.prod(shape))
+            offset = data['times_offset'].numpy()[idx*R:(idx+1)*R + 1]
+            sample.update({'times': data['times'].numpy()[offset[0]:offset[-1]],
+                           'times_offset': offset - offset[0],
+                           'times_shape': shape, 'T': self.T, 'step': self.step})
+        return sample
+
+    def get_batch(self, idx):
+        """
+        Batch of the positions idx as one dict of tensors, the same as
+        collating the samples (collate_times for outcome_times).
+        DataLoader calls it with the index lists of a BatchSampler, see
+        batch_loader.
+        """
+        idx = np.asarray(idx, dtype=int)
+        shape = self.rows_shape()
+        if self.preload:
+            if self.mode not in self.preloaded:
+                self.preloaded[self.mode] = self.load_all()
+            data = self.preloaded[self.mode]
+            _idx = torch.from_numpy(idx)
+            batch = {key: value[_idx] for key, value in data.items()
+                     if key not in ['times', 'times_offset']}
+            if self.outcome_times:
+                R = int(np.prod(shape))
+                rows = (idx[:, None]*R + np.arange(R)).reshape(-1)
+                times, offset = util_outcome.take_events(
+                    data['times'].numpy(), data['times_offset'].numpy(), rows)
+        else:
+            batch = self.load_batch(idx)
+            if self.outcome_times:
+                times, offset = batch.pop('times'), batch.pop('times_offset')
+
+        if self.mode == 'train' and 'mask' not in batch:
+            batch['mask'] = []
+        if self.outcome_times:
+            batch.update({'times': torch.from_numpy(times),
+                          'times_offset': torch.from_numpy(offset),
+                          'times_shape': [len(idx)] + list(shape),
+                          'T': self.T, 'step': self.step})
+        return batch
+
     def get_train(self, idx):
         idx = self.id[idx]
         idx = int(idx)
         _idx = int(self.facutual_id[idx])
 
-        fname = self.xzpath + 'xz_' + str(_idx) + '.pkl'
-        with open(fname, 'rb') as f:
-            xz = pickle.load(f).toarray()[0]
-        x = xz[:-9]
-        x[x != 0] = 1 
-        z = xz[-9:]
-        z = z.astype(np.float32)
-
-        imgs = self.getseatgraph.get(x)
-        for (i, _img) in enumerate(imgs):
-            imgs[i] = _img.astype(np.float32)
-
-        m = np.loadtxt(self.dirpath + 'data/y/outcome_' +
-                       str(_idx) + '.csv', delimiter=',').astype(np.float32)
+        x = self.store.get_x_packed(_idx)
+        z = self.store.get_z(_idx)
+        imgs = self.getseatgraph.get(x, packed=True)
 
         if self.obs_prop != 0.0:
             mask = np.loadtxt(self.dirpath + 'data/mask/mask_' +
@@ -221,65 +612,45 @@ class ShinkokuDataset(Dataset):
 
         sample = {'oh1f': imgs[0], 'oh2f': imgs[1], 'oh3f': imgs[2], 'oh4f': imgs[3],
                   'ph': imgs[4], 'tf': imgs[5],
-                  'treatment': z, 'outcome': m, 'mean': m, 'mask': mask}
+                  'treatment': z, 'mask': mask}
+        if self.prop_k > 0:
+            sample['xprop'] = self.store.get_prop(_idx, self.prop_k)
 
-        return sample
+        return self.set_outcome(sample, _idx)
 
     def get_valid(self, idx):
         idx = self.id[idx]
         idx = int(idx)
         _idx = int(self.valid_id[idx])
-        fname = self.xzpath + 'xz_' + str(_idx) + '.pkl'
-        with open(fname, 'rb') as f:
-            xz = pickle.load(f).toarray()[0]
-        x = xz[:-9]
-        x[x != 0] = 1 
-        z = xz[-9:]
-        z = z.astype(np.float32)
-
-        imgs = self.getseatgraph.get(x)
-        for (i, _img) in enumerate(imgs):
-            imgs[i] = _img.astype(np.float32)
+        x = self.store.get_x_packed(_idx)
+        z = self.store.get_z(_idx)
+        imgs = self.getseatgraph.get(x, packed=True)
 
-        m = np.loadtxt(self.dirpath + 'data/y/outcome_' +
-                       str(_idx) + '.csv', delimiter=',').astype(np.float32)
         sample = {'oh1f': imgs[0], 'oh2f': imgs[1], 'oh3f': imgs[2], 'oh4f': imgs[3],
                   'ph': imgs[4], 'tf': imgs[5],
-                  'treatment': z, 'outcome': m, 'mean': m}
-        return sample
+                  'treatment': z}
+        if self.prop_k > 0:
+            sample['xprop'] = self.store.get_prop(_idx, self.prop_k)
+        return self.set_outcome(sample, _idx)
 
     def get_test(self, idx):
         idx = self.id[idx]
         idx = int(idx)
-        same_pop_id = self.same_pop[idx]
-        fname = self.xzpath + 'xz_' + str(same_pop_id[0]) + '.pkl'
-        with open(fname, 'rb') as f:
-            xz = pickle.load(f).toarray()[0]
-        x = xz[:-9]
-        x[x != 0] = 1 
+        same_pop_id = self.store.get_rows(idx, self.treatment_k)
+        x = self.store.get_x_packed(idx, group=True)
 
         z = self.treatment_unique
         z = z.astype(np.float32)
-        imgs = self.getseatgraph.get(x)
-        for (i, _img) in enumerate(imgs):
-            imgs[i] = _img.astype(np.float32)
-
-        mean = []
-        outcome = []
-        for _idx in same_pop_id:
-            _mean = np.loadtxt(self.dirpath + 'data/y/outcome_' +
-                               str(_idx) + '.csv', delimiter=',').astype(np.float32)
-            _outcome = np.loadtxt(self.dirpath + 'data/y/outcome_pois_' +
-                                  str(_idx) + '.csv', delimiter=',').astype(np.float32)
-            mean.append(_mean)
-            outcome.append(_outcome)
-
-        m = np.array(mean).squeeze()
+        imgs = self.getseatgraph.get(x, packed=True)
+
         sample = {'oh1f': imgs[0], 'oh2f': imgs[1], 'oh3f': imgs[2], 'oh4f': imgs[3],
                   'ph': imgs[4], 'tf': imgs[5],
-                  'treatment': z, 'outcome': m, 'mean': m}
+                  'treatment': z}
+        if self.prop_k > 0:
+            sample['xprop'] = self.store.get_prop(idx, self.prop_k, group=True)
 
-        return sample
+        # outcomes of every treatment in the set as one block
+        return self.set_outcome(sample, same_pop_id, group=idx)
 
 
 if __name__ == '__main__':
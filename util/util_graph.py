@@ -1,7 +1,13 @@
 # encoding: utf-8
 # !/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import hashlib
 import torch
 import argparse
+import torch.nn.functional as F
 import numpy as np
 import pandas as pd
 import networkx as nx
@@ -9,6 +15,8 @@ from sklearn import preprocessing
 from matplotlib import pylab as plt
 from sklearn.metrics import pairwise_distances
 
+import util_seatgraph
+
 import matplotlib as mpl
 mpl.use('Agg')
 
@@ -91,8 +99,142 @@ class Graph():
         return self.A
 
 
+def adj2lap(A):
+    # symmetric normalized adjacency with self loops D^-1/2 (A + I) D^-1/2
+    # scaling rows and columns by D^-1/2 instead of two dense diag products
+    A = A + torch.eye(A.shape[0])
+    d = torch.rsqrt(A.sum(dim=1))
+    return d[:, None] * A * d[None, :]
+
+
+def to_sparse(W):
+    # CSR copies of the normalized seat graphs for GraphConvolution
+    return {key: value.to_sparse_csr() for key, value in W.items()}
+
+
+# version of the graph construction (Graph, adj2lap, util_seatgraph), bump
+# it when the graphs they build change so that data/graph_cache/ and the
+# propagated occupancy of the store are rebuilt
+GRAPH_VERSION = 1
+
+
+def graph_key(dirpath, seatname, withtime):
+    # everything the graphs are built from
+    h = hashlib.blake2b(digest_size=16)
+    h.update(seatname.to_csv(index=False).encode())
+    for fname in [dirpath + 'source/node_coord.csv',
+                  dirpath + 'source/node_node_distance_edit.csv']:
+        with open(fname, 'rb') as f:
+            h.update(f.read())
+    h.update(json.dumps([GRAPH_VERSION, util_seatgraph.venue_gaps, withtime]).encode())
+    return h.hexdigest()
+
+
+def load_graphs(dirpath, seatname, withtime=False, cache=True):
+    """
+    Normalized adjacency (adj2lap) of the route graph 'A' and of the seat
+    graphs 'W' of the six venues, with the venue covariate ids and the route
+    node names. Cached in data/graph_cache/ under a hash of their inputs and
+    GRAPH_VERSION, so networkx only runs when seats, nodes, edges or the
+    version of the builders change.
+    """
+    path = dirpath + 'data/graph_cache/'
+    fname = path + graph_key(dirpath, seatname, withtime) + '.pt'
+    if cache and os.path.exists(fname):
+        return torch.load(fname)
+
+    getseatgraph = util_seatgraph.GetSeatGraph(seatname, withtime)
+    graph = Graph(pd.read_csv(dirpath + 'source/node_coord.csv'),
+                  pd.read_csv(dirpath + 'source/node_node_distance_edit.csv'))
+    W = getseatgraph.get_graph()
+    graphs = {'A': adj2lap(graph.get()),
+              'W': {key: adj2lap(value) for key, value in W.items()},
+              'covariate_id': [torch.from_numpy(c) for c in np.split(
+                  getseatgraph.index.covariate_id, getseatgraph.index.offset[1:-1])],
+              'node_name': list(graph.node_name)}
+    if cache:
+        if not os.path.exists(path):
+            os.mkdir(path)
+        torch.save(graphs, fname + '.tmp')
+        os.replace(fname + '.tmp', fname)
+    return graphs
+
+
+def benchmark(fname, batch=32, hidden=[40, 40], repeat=20):
+    """
+    Forward and backward time of the two GraphConvolution layers of the
+    repnet on the seat graphs of a graph cache file, dense vs sparse A.
+    """
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'model'))
+    from layer import GraphConvolution
+
+    W = torch.load(fname)['W']
+    gc1 = GraphConvolution(1, hidden[0], 0.0)
+    gc2 = GraphConvolution(hidden[0], hidden[1], 0.0)
+
+    def step(A, X):
+        gc2(A, F.selu(gc1(A, X))).mean(1).sum().backward()
+
+    for key, value in sorted(W.items(), key=lambda kv: len(kv[1])):
+        X = torch.rand(batch, len(value), 1)
+        elapsed = {}
+        for name, A in [('dense', value), ('sparse', value.to_sparse_csr())]:
+            step(A, X)
+            s = time.time()
+            for _ in range(repeat):
+                step(A, X)
+            elapsed[name] = (time.time() - s) / repeat * 1e3
+        print('%s: %d seats, %.2f%% nonzero, dense %.2f ms, sparse %.2f ms (x%.1f)' % (
+            key, len(value), 100 * (value != 0).float().mean(),
+            elapsed['dense'], elapsed['sparse'], elapsed['dense'] / elapsed['sparse']))
+
+
+def benchmark_occupied(fname, occupancy, batch=32, hidden=[40, 40], repeat=20):
+    """
+    Forward and backward time of the repnet (GCN_loading) of single_model_gnn_mlp
+    on the block-diagonal graph of the venues, all seats (--block_venues) vs
+    occupied seats only (--occupied), by the share of occupied seats.
+    """
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'model'))
+    from layer import block_adjacency, segment_matrix
+    from single_model_gnn_mlp import GCN_loading
+
+    W = list(torch.load(fname)['W'].values())
+    A, S = block_adjacency(W), segment_matrix([len(w) for w in W])
+    repnet = GCN_loading(1, hidden, argparse.Namespace(dp=0.0, act='selu'))
+    steps = {'all': lambda X: repnet(A, X, S),
+             'occupied': lambda X: repnet.forward_occupied(A, X, S)}
+    for p in occupancy:
+        X = torch.bernoulli(torch.full((batch, A.shape[0]), p))
+        elapsed = {}
+        for name, step in steps.items():
+            step(X).sum().backward()
+            s = time.time()
+            for _ in range(repeat):
+                step(X).sum().backward()
+            elapsed[name] = (time.time() - s) / repeat * 1e3
+        print('%.0f%% occupied: all seats %.2f ms, occupied seats %.2f ms (x%.1f)' % (
+            100 * p, elapsed['all'], elapsed['occupied'], elapsed['all'] / elapsed['occupied']))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='PyTorch Example')
+    parser.add_argument('--bench', type=str, default=None,
+                        help='graph cache file (data/graph_cache/<hash>.pt): '
+                        'time the graph convolutions with dense and sparse adjacency')
+    parser.add_argument('--occupancy', type=str, default=None,
+                        help='with --bench: time --occupied against --block_venues at these '
+                        'shares of occupied seats (e.g. 0.01,0.05,0.1,0.3,1.0)')
+    parser.add_argument('--batch', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    if args.bench is not None and args.occupancy is not None:
+        benchmark_occupied(args.bench, [float(p) for p in args.occupancy.split(',')],
+                           args.batch, repeat=args.repeat)
+        sys.exit(0)
+    if args.bench is not None:
+        benchmark(args.bench, args.batch, repeat=args.repeat)
+        sys.exit(0)
     dirpath = '/home/koh/data/2021/shinkoku/'
 
     node = pd.read_csv(dirpath + 'data/node_coord.csv')
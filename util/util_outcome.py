@@ -0,0 +1,91 @@
+# encoding: utf-8
+# !/usr/bin/env python3
+import numpy as np
+import torch
+
+
+def get_events(times):
+    """
+    Evacuation times of the occupied seats of a batch of simulation rows.
+
+    times: [N, seat] evacuation time of each seat (nan for an empty seat)
+    return: times [E] int16 (int(t), sorted inside each row, clipped to the
+            int16 range), counts [N]
+    """
+    N = times.shape[0]
+    row, seat = np.where(~np.isnan(times))
+    t = np.clip(times[row, seat].astype(int), -2**15, 2**15 - 1)
+    order = np.lexsort((t, row))
+    return t[order].astype(np.int16), np.bincount(row, minlength=N)
+
+
+def take_events(times, offset, rows):
+    """
+    Event times of some rows.
+
+    times: [E], offset: [R + 1] row r is times[offset[r]:offset[r+1]]
+    rows: [n] row ids, a negative row (not simulated) has no events
+    return: times [e], offset [n + 1]
+    """
+    rows = np.atleast_1d(rows)
+    if len(rows) == 0:
+        return np.array(times[:0]), np.zeros(1, dtype=np.int64)
+    missing = rows < 0
+    start, end = offset[np.maximum(rows, 0)], offset[np.maximum(rows, 0) + 1]
+    start[missing], end[missing] = 0, 0
+    if not missing.any() and (len(rows) == 1 or (np.diff(rows) == 1).all()):
+        # consecutive rows are one slice
+        _times = np.array(times[start[0]:end[-1]])
+    else:
+        _times = np.concatenate([times[s:e] for s, e in zip(start, end)])
+    return _times, np.r_[0, np.cumsum(end - start)]
+
+
+def times2curve(times, offset, T=1289+1, step=1):
+    """
+    Cumulative number of evacuated agents from the event times.
+
+    times: [E] int16 event times of R rows (numpy array or torch tensor)
+    offset: [R + 1] row r is times[offset[r]:offset[r+1]]
+    T: length of the curve
+    step: seconds per time step of the curve
+    return: [R, T] float32, curve[r, k] = #{t of row r: 0 <= t <= k*step}
+    """
+    if torch.is_tensor(times):
+        offset = offset.to(device=times.device)
+        R = len(offset) - 1
+        row = torch.repeat_interleave(
+            torch.arange(R, device=times.device), offset[1:] - offset[:-1])
+        t = times.long()
+        k = torch.div(t + step - 1, step, rounding_mode='floor')
+        keep = (0 <= t) & (k < T)
+        hist = torch.bincount(row[keep] * T + k[keep], minlength=R * T)
+        return hist.reshape([R, T]).cumsum(1).float()
+
+    offset = np.asarray(offset)
+    R = len(offset) - 1
+    row = np.repeat(np.arange(R), np.diff(offset))
+    t = np.asarray(times).astype(np.int64)
+    k = -(-t // step)
+    keep = (0 <= t) & (k < T)
+    hist = np.bincount(row[keep] * T + k[keep], minlength=R * T)
+    return hist.reshape([R, T]).cumsum(1).astype(np.float32)
+
+
+def poisson_noise(curve, rows, replicate=0, seed=0):
+    """
+    Poisson observation noise of the curves of rows.
+
+    Every (row, replicate) has its own counter of a Philox generator, so the
+    noise of a row does not depend on the batch it is read in.
+    curve: [R, T], rows: [R] row ids of the store (not negative)
+    """
+    rows = np.asarray(rows)
+    if (rows < 0).any():
+        raise ValueError('poisson_noise: negative row ids have no noise counter')
+    noisy = np.empty(curve.shape, dtype=np.float32)
+    for i, row in enumerate(rows):
+        rng = np.random.Generator(np.random.Philox(
+            key=seed, counter=[0, 0, replicate, row]))
+        noisy[i] = rng.poisson(curve[i])
+    return noisy
@@ -1,6 +1,9 @@
 # encoding: utf-8
 # !/usr/bin/env python3
 
+import sys
+import time
+import hashlib
 import argparse
 import numpy as np
 import pandas as pd
@@ -15,17 +18,36 @@ import matplotlib as mpl
 mpl.use('Agg')
 
 
+def group_rows(idrowcol):
+    # nodes of every row in their order, rows[row] is the same as
+    # [x for x in idrowcol if x['row'] == row]
+    rows = {}
+    for x in idrowcol:
+        rows.setdefault(x['row'], []).append(x)
+    return rows
+
+
+def index_rowcol(idrowcol):
+    # first node of every (row, col), index[(row, col)] is the same as
+    # [x for x in idrowcol if x['row'] == row and x['col'] == col][0]
+    index = {}
+    for x in idrowcol:
+        index.setdefault((x['row'], x['col']), x)
+    return index
+
+
 def connect_row(id, idrowcol, G, gaps):
     # 行のリストを取得
     rowlist = np.unique(id[:, 0])
+    rows = group_rows(idrowcol)
+    index = index_rowcol(idrowcol)
 
     # row列目の横を繋ぐ
     for row in rowlist:
         # print('connect %d-th row' % row)
-        nodes = [x for x in idrowcol if x['row'] == row]
+        nodes = rows.get(row, [])
         for s in nodes[:-1]:
-            e = [x for x in nodes if x['row'] ==
-                 s['row'] and x['col'] == s['col'] + 1][0]
+            e = index[(s['row'], s['col'] + 1)]
             if s['col'] != gaps[0][0] and e['col'] != gaps[0][1]:
                 if s['col'] != gaps[1][0] and e['col'] != gaps[1][1]:
                     G = add_edge(G, s, e)
@@ -36,25 +58,27 @@ def connect_leftright(id, idrowcol, G):
     # 行のリストを取得
     rowlist = np.unique(id[:, 0])
 
+    rows = group_rows(idrowcol)
+
     lefts = []
     rights = []
     # row列目の一番左を取得
     for row in rowlist:
         # print('connect %d-th row' % row)
-        nodes = [x for x in idrowcol if x['row'] == row]
-        left = sorted(nodes, key=lambda x: x['col'])[0]
-        right = sorted(nodes, key=lambda x: x['col'])[-1]
-        lefts.append(left)
-        rights.append(right)
+        nodes = sorted(rows.get(row, []), key=lambda x: x['col'])
+        lefts.append(nodes[0])
+        rights.append(nodes[-1])
 
     # print('add left edges')
+    left_rows = group_rows(lefts)
     for s in lefts[:-1]:
-        e = [x for x in lefts if x['row'] == s['row'] + 1][0]
+        e = left_rows[s['row'] + 1][0]
         G = add_edge(G, s, e)
 
     # print('add right edges')
+    right_rows = group_rows(rights)
     for s in rights[:-1]:
-        e = [x for x in rights if x['row'] == s['row'] + 1][0]
+        e = right_rows[s['row'] + 1][0]
         G = add_edge(G, s, e)
 
     return G
@@ -63,22 +87,22 @@ def connect_leftright(id, idrowcol, G):
 def connect_gap(id, idrowcol, G, gaps):
     # 行のリストを取得
     rowlist = np.unique(id[:, 0])
+    index = index_rowcol(idrowcol)
     # row列目のgapの左右を取得
     for gap in gaps:
         gap_nodes = []
         for row in rowlist:
             # # print('connect %d-th row' % row)
-            nodes = [x for x in idrowcol if x['row'] == row]
-            left = [x for x in nodes if x['col'] == gap[0]][0]
-            right = [x for x in nodes if x['col'] == gap[1]][0]
+            left = index[(row, gap[0])]
+            right = index[(row, gap[1])]
             gap_nodes.append([left, right])
 
         # 列間でノードを繋ぐ
+        left_index = index_rowcol([x[0] for x in gap_nodes])
+        right_index = index_rowcol([x[1] for x in gap_nodes])
         for s_left, s_right in gap_nodes[:-1]:
-            e_left = [x[0] for x in gap_nodes if x[0]['row'] ==
-                      s_left['row']+1 and x[0]['col'] == s_left['col']][0]
-            e_right = [x[1] for x in gap_nodes if x[1]['row'] ==
-                       s_right['row']+1 and x[1]['col'] == s_right['col']][0]
+            e_left = left_index[(s_left['row']+1, s_left['col'])]
+            e_right = right_index[(s_right['row']+1, s_right['col'])]
             G = add_edge(G, s_left, s_right)
             G = add_edge(G, s_left, e_left)
             G = add_edge(G, s_left, e_right)
@@ -89,6 +113,64 @@ def connect_gap(id, idrowcol, G, gaps):
     return G
 
 
+def get_bits(xbits, covariate_id):
+    """
+    Seats covariate_id of a bit-packed occupancy.
+
+    xbits: [..., ceil(seat/8)] np.packbits of the 0/1 occupancy (numpy array
+           or uint8 torch tensor, then covariate_id is a tensor on its device)
+    return: [..., len(covariate_id)] float32
+    """
+    bits = (xbits[..., covariate_id >> 3] >> (7 - (covariate_id & 7))) & 1
+    if torch.is_tensor(bits):
+        return bits.float()
+    return bits.astype(np.float32)
+
+
+class VenueIndex():
+    """
+    Concatenated covariate ids of the venues and their offsets, so that the
+    venues of an occupancy [..., seat] are one gather split into views.
+    """
+
+    def __init__(self, covariate_ids):
+        self.covariate_id = np.concatenate(covariate_ids)
+        self.sizes = [len(c) for c in covariate_ids]
+        self.offset = np.r_[0, np.cumsum(self.sizes)]
+        self.torch_id = {}
+
+    def __getstate__(self):
+        # the device copies of the index are rebuilt where they are used
+        state = self.__dict__.copy()
+        state['torch_id'] = {}
+        return state
+
+    def get_id(self, x):
+        if not torch.is_tensor(x):
+            return self.covariate_id
+        if x.device not in self.torch_id:
+            self.torch_id[x.device] = torch.from_numpy(
+                self.covariate_id).to(device=x.device)
+        return self.torch_id[x.device]
+
+    def get(self, x, packed=False):
+        """
+        x: [..., seat] occupancy (or [..., ceil(seat/8)] packbits if packed),
+           numpy array, pandas Series or torch tensor on any device
+        return: list of the venue occupancies [..., seat of the venue]
+        """
+        if not torch.is_tensor(x) and not type(x) == np.ndarray:
+            x = x.to_numpy()
+        covariate_id = self.get_id(x)
+        if packed:
+            x = get_bits(x, covariate_id)
+        else:
+            x = x[..., covariate_id]
+        if torch.is_tensor(x):
+            return list(torch.split(x, self.sizes, dim=-1))
+        return np.split(x, self.offset[1:-1], axis=-1)
+
+
 def add_edge(G, s, e):
     '''
     try:
@@ -198,27 +280,28 @@ class OH2F():
     def connect_L_rows(self, key='left'):
         leftnodes = [x for x in self.idrowcol if x[key] == 1]
         maxrow = max([x['row'] for x in leftnodes])
+        rows = group_rows(leftnodes)
         for _r in range(maxrow):
-            nodes = [x for x in leftnodes if x['row'] == _r]
-            self.connect_L(nodes)
+            self.connect_L(rows.get(_r, []))
 
     def connect_L(self, nodes):
+        index = index_rowcol(nodes)
         for s in nodes[:-1]:
-            e = [x for x in nodes if x['row'] ==
-                 s['row'] and x['col'] == s['col'] + 1][0]
+            e = index[(s['row'], s['col'] + 1)]
             self.G = add_edge(self.G, s, e)
 
     def connect_row(self):
         rownodes = [x for x in self.idrowcol if x['left']
                     == 0 and x['right'] == 0]
         rows = np.unique([x['row'] for x in rownodes])
+        row_nodes = group_rows(rownodes)
+        index = index_rowcol(rownodes)
         # row列目の横を繋ぐ
         for row in rows:
             # print('connect %d-th row' % row)
-            nodes = [x for x in rownodes if x['row'] == row]
+            nodes = row_nodes[row]
             for s in nodes[:-1]:
-                e = [x for x in nodes if x['row'] ==
-                     s['row'] and x['col'] == s['col'] + 1][0]
+                e = index[(s['row'], s['col'] + 1)]
                 if s['col'] != self.gaps[0][0] and e['col'] != self.gaps[0][1]:
                     if s['col'] != self.gaps[1][0] and e['col'] != self.gaps[1][1]:
                         self.G = add_edge(self.G, s, e)
@@ -227,9 +310,10 @@ class OH2F():
         # L有り行で繋ぐ
         leftnodes = [x for x in self.idrowcol if x['left'] == 1]
         Left_rows = np.unique([x['row'] for x in leftnodes])
+        left_nodes = group_rows(leftnodes)
         for row in Left_rows:
             # print('connect %d-th row' % row)
-            nodes = [x for x in leftnodes if x['row'] == row]
+            nodes = left_nodes[row]
             if row == 0:
                 s0 = nodes[-1]
                 s1 = nodes[-1]
@@ -255,9 +339,10 @@ class OH2F():
         # L有り行で繋ぐ
         leftnodes = [x for x in self.idrowcol if x['right'] == 1]
         Left_rows = np.unique([x['row'] for x in leftnodes])
+        left_nodes = group_rows(leftnodes)
         for row in Left_rows:
             # print('connect %d-th row' % row)
-            nodes = [x for x in leftnodes if x['row'] == row]
+            nodes = left_nodes[row]
             if row == 0:
                 s0 = nodes[-1]
                 s1 = nodes[-1]
@@ -283,13 +368,13 @@ class OH2F():
         normalnodes = [x for x in self.idrowcol if x['left']
                        == 0 and x['right'] == 0]
         normal_rows = np.unique([x['row'] for x in normalnodes])
+        index = index_rowcol(normalnodes)
         for i, row in enumerate(normal_rows):
             # print('connect %d-th row' % row)
-            rownodes = [x for x in normalnodes if x['row'] == row]
-            e0 = [x for x in rownodes if x['col'] == self.gaps[0][0]][0]
-            e1 = [x for x in rownodes if x['col'] == self.gaps[0][1]][0]
-            e2 = [x for x in rownodes if x['col'] == self.gaps[1][0]][0]
-            e3 = [x for x in rownodes if x['col'] == self.gaps[1][1]][0]
+            e0 = index[(row, self.gaps[0][0])]
+            e1 = index[(row, self.gaps[0][1])]
+            e2 = index[(row, self.gaps[1][0])]
+            e3 = index[(row, self.gaps[1][1])]
             if i == 0:
                 self.G = add_edge(self.G, e0, e1)
                 self.G = add_edge(self.G, e2, e3)
@@ -365,16 +450,15 @@ class PH():
     def connect_row(self, idrowcol):
         rownodes = idrowcol
         rows = np.unique([x['row'] for x in rownodes])
+        row_nodes = group_rows(rownodes)
+        index = index_rowcol(rownodes)
         # row列目の横を繋ぐ
         for row in rows:
             # print('connect %d-th row' % row)
-            nodes = [x for x in rownodes if x['row'] == row]
+            nodes = row_nodes[row]
             for s in nodes[:-1]:
-                e = [x for x in nodes if x['row'] ==
-                     s['row'] and x['col'] == s['col'] + 1]
-                if len(e) != 0:
-                    e = e[0]
-                else:
+                e = index.get((s['row'], s['col'] + 1))
+                if e is None:
                     continue
                 if s['col'] != self.gaps[0][0] and e['col'] != self.gaps[0][1]:
                     if s['col'] != self.gaps[1][0] and e['col'] != self.gaps[1][1]:
@@ -383,27 +467,25 @@ class PH():
     def connect_gap_1f(self, idrowcol):
         nodes = idrowcol
         rows = np.unique([x['row'] for x in nodes])
+        index = index_rowcol(nodes)
         for i, row in enumerate(rows):
             # print('connect %d-th row' % row)
-            rownodes = [x for x in nodes if x['row'] == row]
             if i == 0:
-                e0 = [x for x in rownodes if x['col'] == self.gaps[0][1]][0]
-                e1 = [x for x in rownodes if x['col'] == self.gaps[0][1]][0]
-                e2 = [x for x in rownodes if x['col'] == self.gaps[1][0]][0]
-                e3 = [x for x in rownodes if x['col'] == self.gaps[1][0]][0]
+                e0 = index[(row, self.gaps[0][1])]
+                e1 = index[(row, self.gaps[0][1])]
+                e2 = index[(row, self.gaps[1][0])]
+                e3 = index[(row, self.gaps[1][0])]
             elif i == 20:
                 continue
             else:
-                e0 = [x for x in rownodes if x['col'] == self.gaps[0][0]][0]
-                e1 = [x for x in rownodes if x['col'] == self.gaps[0][1]][0]
+                e0 = index[(row, self.gaps[0][0])]
+                e1 = index[(row, self.gaps[0][1])]
                 if row < 9:
-                    e2 = [x for x in rownodes if x['col'] == self.gaps[1][0]][0]
-                    e3 = [x for x in rownodes if x['col'] == self.gaps[1][1]][0]
+                    e2 = index[(row, self.gaps[1][0])]
+                    e3 = index[(row, self.gaps[1][1])]
                 if i >= 9:
-                    e2 = [x for x in rownodes if x['col']
-                          == self.gaps_1f[row - 9]][0]
-                    e3 = [x for x in rownodes if x['col']
-                          == (self.gaps_1f[row - 9]+1)][0]
+                    e2 = index[(row, self.gaps_1f[row - 9])]
+                    e3 = index[(row, self.gaps_1f[row - 9]+1)]
 
                 self.G = add_edge(self.G, s0, e0)
                 self.G = add_edge(self.G, s0, e1)
@@ -425,13 +507,13 @@ class PH():
     def connect_gap_2f(self, idrowcol):
         nodes = idrowcol
         rows = np.unique([x['row'] for x in nodes])
+        index = index_rowcol(nodes)
         for i, row in enumerate(rows):
             # print('connect %d-th row' % row)
-            rownodes = [x for x in nodes if x['row'] == row]
-            e0 = [x for x in rownodes if x['col'] == 30][0]
-            e1 = [x for x in rownodes if x['col'] == 31][0]
-            e2 = [x for x in rownodes if x['col'] == 54][0]
-            e3 = [x for x in rownodes if x['col'] == 55][0]
+            e0 = index[(row, 30)]
+            e1 = index[(row, 31)]
+            e2 = index[(row, 54)]
+            e3 = index[(row, 55)]
             if i != 0:
                 self.G = add_edge(self.G, s0, e0)
                 self.G = add_edge(self.G, s0, e1)
@@ -454,9 +536,10 @@ class PH():
         nodes = idrowcol
         # L無し行で繋ぐ
         rows = np.unique([x['row'] for x in nodes])
+        row_nodes = group_rows(nodes)
         for row in rows:
             # print('connect %d-th row' % row)
-            rownodes = [x for x in nodes if x['row'] == row]
+            rownodes = row_nodes[row]
             e0 = rownodes[0]
             e1 = rownodes[-1]
             if row > 0:
@@ -467,7 +550,7 @@ class PH():
             s1 = e1
 
     def get_node(self, nodes, col):
-        node = [x for x in nodes if x['col'] == col][0]
+        node = next(x for x in nodes if x['col'] == col)
         return node
 
     def connect_1f2f(self, idrowcol_1f, idrowcol_2f):
@@ -479,8 +562,11 @@ class PH():
         exit5_nodes = []
         exit6_nodes = []
 
+        rows_1f = group_rows(nodes_1f)
+        rows_2f = group_rows(nodes_2f)
+
         row = 19
-        rownodes = [x for x in nodes_1f if x['row'] == row]
+        rownodes = rows_1f[row]
         exit3_nodes.append(self.get_node(rownodes, 13))
         exit4_nodes.append(self.get_node(rownodes, 31))
         exit4_nodes.append(self.get_node(rownodes, 32))
@@ -489,14 +575,14 @@ class PH():
         exit6_nodes.append(self.get_node(rownodes, 73))
 
         row = 20
-        rownodes = [x for x in nodes_1f if x['row'] == row]
+        rownodes = rows_1f[row]
         exit3_nodes.append(self.get_node(rownodes, 20))
         exit4_nodes.append(self.get_node(rownodes, 31))
         exit5_nodes.append(self.get_node(rownodes, 55))
         exit6_nodes.append(self.get_node(rownodes, 66))
 
         row = 23
-        rownodes = [x for x in nodes_2f if x['row'] == row]
+        rownodes = rows_2f[row]
         exit3_nodes.append(self.get_node(rownodes, 12))
         exit4_nodes.append(self.get_node(rownodes, 30))
         exit4_nodes.append(self.get_node(rownodes, 31))
@@ -574,13 +660,10 @@ class TF():
     def connect_rows_1f(self):
         for row in self.rows:
             # print('connect %s-th row' % row)
-            nodes = [x for x in self.idrowcol if x['row'] == row]
+            nodes = self.row_nodes.get(row, [])
             for s in nodes[:-1]:
-                e = [x for x in nodes if x['row'] ==
-                     s['row'] and x['col'] == s['col'] + 1]
-                if len(e) != 0:
-                    e = e[0]
-                else:
+                e = self.index.get((s['row'], s['col'] + 1))
+                if e is None:
                     continue
                 if s['col'] != self.gaps[0][0] and e['col'] != self.gaps[0][1]:
                     if s['col'] != self.gaps[1][0] and e['col'] != self.gaps[1][1]:
@@ -589,23 +672,19 @@ class TF():
     def connect_rows_2f(self):
         for row in self.rows_2f:
             # print('connect %s-th row' % row)
-            nodes = [x for x in self.idrowcol if x['row'] == row]
+            nodes = self.row_nodes.get(row, [])
             for s in nodes[:-1]:
-                e = [x for x in nodes if x['row'] ==
-                     s['row'] and x['col'] == s['col'] + 1]
-                if len(e) != 0:
-                    e = e[0]
-                else:
+                e = self.index.get((s['row'], s['col'] + 1))
+                if e is None:
                     continue
                 self.G = add_edge(self.G, s, e)
 
     def connect_leftrightgap(self):
         for row in self.rows:
-            nodes = [x for x in self.idrowcol if x['row'] == row]
-            e0 = [x for x in nodes if x['col'] == 0][0]
-            e10 = [x for x in nodes if x['col'] == 4][0]
-            e11 = [x for x in nodes if x['col'] == 5][0]
-            e2 = [x for x in nodes if x['col'] == 17][0]
+            e0 = self.index[(row, 0)]
+            e10 = self.index[(row, 4)]
+            e11 = self.index[(row, 5)]
+            e2 = self.index[(row, 17)]
             if row != 'A3':
                 self.G = add_edge(self.G, s0, e0)
 
@@ -638,6 +717,8 @@ class TF():
         self.id = id.reset_index()[['row', 'col']]
 
         self.idrowcol = self.get_idrowcol(id)
+        self.row_nodes = group_rows(self.idrowcol)
+        self.index = index_rowcol(self.idrowcol)
 
         self.rows = ['A3', 'B1', 'B2', 'B3', 'C1', 'C2', 'C3',
                      'C4', 'C5', 'C6', 'D1', 'D2', 'D3', 'D4', 'D5', 'D6']
@@ -667,16 +748,24 @@ class TF():
         return x
 
 
+# aisle gaps (columns) of the seat rows of the venues
+venue_gaps = {'oh1f': [[10, 11], [30, 31]], 'oh2f': [[13, 14], [33, 34]],
+              'oh3f': [[15, 16], [35, 36]], 'oh4f': [[19, 20], [38, 39]]}
+
+
 class GetSeatGraph():
     def __init__(self, seatname, withtime=False):
         self.seatname = seatname
         self.withtime = withtime
-        self.oh1f = OH1F(seatname, floor='1F', gaps=[[10, 11], [30, 31]])
-        self.oh2f = OH2F(seatname, floor='2F', gaps=[[13, 14], [33, 34]])
-        self.oh3f = OH2F(seatname, floor='3F', gaps=[[15, 16], [35, 36]])
-        self.oh4f = OH2F(seatname, floor='4F', gaps=[[19, 20], [38, 39]])
+        self.oh1f = OH1F(seatname, floor='1F', gaps=venue_gaps['oh1f'])
+        self.oh2f = OH2F(seatname, floor='2F', gaps=venue_gaps['oh2f'])
+        self.oh3f = OH2F(seatname, floor='3F', gaps=venue_gaps['oh3f'])
+        self.oh4f = OH2F(seatname, floor='4F', gaps=venue_gaps['oh4f'])
         self.ph = PH(seatname)
         self.tf = TF(seatname)
+        # one gather index over the six venues
+        self.index = VenueIndex([g.covariate_id for g in [
+            self.oh1f, self.oh2f, self.oh3f, self.oh4f, self.ph, self.tf]])
 
     def get_graph(self):
         oh1f = torch.FloatTensor(self.oh1f.W.astype(np.float32))
@@ -689,18 +778,60 @@ class GetSeatGraph():
                'oh4f': oh4f, 'ph': ph, 'tf': tf}
         return ret
 
-    def get(self, x):
-        oh1f = self.oh1f.get(x)
-        oh2f = self.oh2f.get(x)
-        oh3f = self.oh3f.get(x)
-        oh4f = self.oh4f.get(x)
-        ph = self.ph.get(x)
-        tf = self.tf.get(x)
-        return [oh1f, oh2f, oh3f, oh4f, ph, tf]
+    def get(self, x, packed=False):
+        # [oh1f, oh2f, oh3f, oh4f, ph, tf] of x [..., seat] (see VenueIndex.get)
+        # packed: x is np.packbits of the occupancy ([..., ceil(seat/8)])
+        return self.index.get(x, packed)
+
+
+class SeatBits():
+    """
+    GetSeatGraph.get without the graphs: only the gather index of the six
+    venues (a VenueIndex), small enough to pickle to DataLoader workers.
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    def get(self, x, packed=False):
+        return self.index.get(x, packed)
+
+
+def graph_digest(getseatgraph):
+    # sha256 of the node order and adjacency of the six venues
+    h = hashlib.sha256()
+    for g in [getseatgraph.oh1f, getseatgraph.oh2f, getseatgraph.oh3f,
+              getseatgraph.oh4f, getseatgraph.ph, getseatgraph.tf]:
+        h.update(np.array(list(g.G.nodes), dtype=np.int64).tobytes())
+        h.update(g.W.astype(np.uint8).tobytes())
+    return h.hexdigest()
+
+
+def benchmark(fname, repeat=5):
+    # construction time of GetSeatGraph for the seats of the header of fname
+    with open(fname) as f:
+        _seatname = f.readline().rstrip().split(',')[1:]
+    seatname = pd.DataFrame([np.delete(s.split('_'), 1) for s in _seatname],
+                            columns=['hall', 'floor', 'row', 'col'])
+    elapsed = []
+    for _ in range(repeat):
+        s = time.time()
+        getseatgraph = GetSeatGraph(seatname)
+        elapsed.append(time.time() - s)
+    print('%d seats: %.3f sec (min of %d), sha256 %s' % (
+        len(seatname), min(elapsed), repeat, graph_digest(getseatgraph)))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='PyTorch Example')
+    parser.add_argument('--bench', type=str, default=None,
+                        help='csv whose header are the seats (e.g. data/source/y.csv): '
+                        'time the graph construction and print the digest of the graphs')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    if args.bench is not None:
+        benchmark(args.bench, args.repeat)
+        sys.exit(0)
     dirpath = '/home/koh/data/2021/shinkoku/'
 
     _data = pd.read_csv(dirpath + 'all_seat_1_0.csv')
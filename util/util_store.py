@@ -0,0 +1,239 @@
+# encoding: utf-8
+# !/usr/bin/env python3
+import os
+import json
+import hashlib
+import numpy as np
+
+import util_outcome
+
+
+MANIFEST = 'manifest.json'
+
+
+def mkdir(path):
+    if not os.path.exists(path):
+        os.mkdir(path)
+
+
+def load_manifest(path):
+    fname = os.path.join(path, MANIFEST)
+    if not os.path.exists(fname):
+        return {'arrays': {}, 'attrs': {}}
+    with open(fname) as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+    # write to a temporary file first so that a crash never leaves a
+    # truncated manifest behind
+    fname = os.path.join(path, MANIFEST)
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(fname + '.tmp', fname)
+
+
+def eval_key(attrs):
+    # events, groups and curve length T the evaluation blocks 'eval_mean'
+    # are built from
+    return [attrs.get('events_version'), attrs.get('groups_hash'), attrs.get('T')]
+
+
+def prop_key(xbits, graph):
+    # occupancy and seat graphs (util_graph.graph_key) 'xprop' is built from
+    h = hashlib.blake2b(digest_size=16)
+    h.update(memoryview(np.ascontiguousarray(xbits)))
+    return [h.hexdigest(), graph]
+
+
+class StoreWriter():
+    """
+    Writer of the simulation store.
+
+    Every array is a raw contiguous file ``<name>.bin`` in ``path`` and its
+    dtype and shape are recorded in ``manifest.json``.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        mkdir(path)
+        self.manifest = load_manifest(path)
+        self.arrays = {}
+        # arrays (re)allocated by require
+        self.created = set()
+
+    def create(self, name, dtype, shape, fname=None):
+        fname = name + '.bin' if fname is None else fname
+        shape = tuple(int(s) for s in shape)
+        arr = np.memmap(os.path.join(self.path, fname),
+                        dtype=dtype, mode='w+', shape=shape)
+        self.manifest['arrays'][name] = {
+            'file': fname, 'dtype': np.dtype(dtype).str, 'shape': list(shape)}
+        self.arrays[name] = arr
+        return arr
+
+    def require(self, name, dtype, shape):
+        """
+        Same as create, but an existing array of the same dtype and row shape
+        is kept and only its number of rows is changed, so that rows written
+        by an earlier run survive.
+        """
+        shape = tuple(int(s) for s in shape)
+        info = self.manifest['arrays'].get(name)
+        if info is None or np.dtype(info['dtype']) != np.dtype(dtype) \
+                or tuple(info['shape'][1:]) != shape[1:] \
+                or not os.path.exists(os.path.join(self.path, info['file'])):
+            self.created.add(name)
+            return self.create(name, dtype, shape)
+        if tuple(info['shape']) != shape:
+            self.arrays.pop(name, None)
+            with open(os.path.join(self.path, info['file']), 'r+b') as f:
+                f.truncate(int(np.prod(shape)) * np.dtype(dtype).itemsize)
+            info['shape'] = list(shape)
+        return self.open(name)
+
+    def open(self, name):
+        if name not in self.arrays:
+            info = self.manifest['arrays'][name]
+            self.arrays[name] = np.memmap(
+                os.path.join(self.path, info['file']), dtype=info['dtype'],
+                mode='r+', shape=tuple(info['shape']))
+        return self.arrays[name]
+
+    def remove(self, name):
+        info = self.manifest['arrays'].pop(name, None)
+        self.arrays.pop(name, None)
+        if info is not None and os.path.exists(os.path.join(self.path, info['file'])):
+            os.remove(os.path.join(self.path, info['file']))
+
+    def set_attr(self, key, value):
+        self.manifest['attrs'][key] = value
+
+    def save(self):
+        for arr in self.arrays.values():
+            arr.flush()
+        save_manifest(self.path, self.manifest)
+
+    def close(self):
+        self.save()
+        self.arrays = {}
+
+
+class SimulationStore():
+    """
+    Read-only view of the simulation store written by the preprocessing.
+
+    Arrays are opened lazily with ``np.memmap`` so that fetching one sample is
+    an array slice instead of opening, unpickling and parsing files.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest = load_manifest(path)
+        if len(self.manifest['arrays']) == 0:
+            raise FileNotFoundError(
+                'no simulation store found in %s, run the preprocessing first' % path)
+        self.attrs = self.manifest['attrs']
+        self.arrays = {}
+
+    def __getstate__(self):
+        # a worker process reopens the memmaps, the pickle is only the path
+        state = self.__dict__.copy()
+        state['arrays'] = {}
+        return state
+
+    def __contains__(self, name):
+        return name in self.manifest['arrays']
+
+    def __getitem__(self, name):
+        if name not in self.arrays:
+            info = self.manifest['arrays'][name]
+            self.arrays[name] = np.memmap(
+                os.path.join(self.path, info['file']), dtype=info['dtype'],
+                mode='r', shape=tuple(info['shape']))
+        return self.arrays[name]
+
+    def __len__(self):
+        return self.attrs['n_rows']
+
+    def get_x(self, idx, group=False):
+        # binary seat occupancy
+        return np.unpackbits(self.get_x_packed(idx, group), axis=-1,
+                             count=self.attrs['n_seats']).astype(np.float32)
+
+    def get_x_packed(self, idx, group=False):
+        """
+        np.packbits of the occupancy, see util_seatgraph.GetSeatGraph.get.
+        The occupancy is stored once per group: idx are row ids, or group ids
+        if group is True.
+        """
+        if not group:
+            idx = self['row_group'][idx]
+        return np.array(self['xbits'][idx])
+
+    def get_rows(self, group, k):
+        # rows of (group, index of treatment_unique), -1 if not simulated
+        return np.array(self['group_treatment_row'][group, k])
+
+    def has_eval(self):
+        # eval_mean is up to date with the events and groups
+        return 'eval_mean' in self and self.attrs.get('eval_key') == eval_key(self.attrs) \
+            and self.manifest['arrays']['eval_mean']['shape'][-1] == self.attrs['T']
+
+    def get_eval(self, group, k):
+        """
+        Curves of (group, index of treatment_unique) from the evaluation
+        blocks, the same as get_outcome(get_rows(group, k)).
+        """
+        return np.array(self['eval_mean'][group, k], dtype=np.float32)
+
+    def has_prop(self, graph, k):
+        # xprop has k hops and is up to date with the occupancy and graphs
+        return 'xprop' in self and self.manifest['arrays']['xprop']['shape'][1] >= k \
+            and self.attrs.get('prop_key') == prop_key(self['xbits'], graph)
+
+    def get_prop(self, idx, k, group=False):
+        """
+        Occupancy propagated over the seat graphs [..., k, seat of the
+        venues], see preproc_xz.build_prop. Stored once per group like the
+        occupancy: idx are row ids, or group ids if group is True.
+        """
+        if not group:
+            idx = self['row_group'][idx]
+        return np.array(self['xprop'][idx, :k])
+
+    def get_z(self, idx):
+        return np.array(self['z'][idx], dtype=np.float32)
+
+    def get_group(self, u):
+        # rows sharing the u-th unique proportion
+        offset = self['group_offset']
+        return np.array(self['group_rows'][offset[u]:offset[u + 1]])
+
+    def get_groups(self):
+        offset = np.array(self['group_offset'])
+        return np.split(np.array(self['group_rows']), offset[1:-1])
+
+    def get_times(self, idx):
+        """
+        Event times of rows idx (int or array of row ids), none for -1.
+        return: times [E] int16, offset [len(idx) + 1]
+        """
+        return util_outcome.take_events(
+            self['event_times'], self['event_offset'], idx)
+
+    def get_outcome(self, idx, pois=False, T=None, step=1, replicate=0, seed=0):
+        """
+        Cumulative curves [T] (or [len(idx), T]) built from the event times,
+        zero for the rows -1 of the (group, treatment) not simulated.
+        pois: add the poisson noise of replicate (see util_outcome.poisson_noise)
+        """
+        times, offset = self.get_times(idx)
+        curve = util_outcome.times2curve(
+            times, offset, self.attrs['T'] if T is None else T, step)
+        if pois:
+            rows = np.atleast_1d(idx)
+            keep = rows >= 0
+            curve[keep] = util_outcome.poisson_noise(
+                curve[keep], rows[keep], replicate, seed)
+        return curve[0] if np.ndim(idx) == 0 else curve